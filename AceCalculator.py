@@ -1,75 +1,164 @@
+import hashlib
+import os
 import numpy as np
+import Instrumentation
 
+# one row per HURDAT2 fix, with lat/lon signed (north/east positive)
+hurdatDtype = np.dtype([('storm', 'i4'), ('stormId', 'U8'), ('stormYear', 'i2'), ('year', 'i2'), ('month', 'i1'),
+                        ('day', 'i1'), ('hour', 'i1'), ('minute', 'i1'), ('status', 'U2'), ('lat', 'f4'),
+                        ('lon', 'f4'), ('wind', 'i2')])
 
-def getHurdatData(filePath):
-    # open, read, and close hurdat file
-    f = open(filePath, mode='r')
-    lines = f.readlines()
-    f.close()
+hurdatPath = 'C:/Nikhil Stuff/Coding Stuff/hurdatdata.txt'
+firstSeason = 1970  # first season used, since earlier seasons were observed without satellites
 
-    allData = []
-    stormName = 'AL011851'
-    stormData = []
+
+@Instrumentation.timed('hurdat parse')
+def parseHurdat(filePath):
+    """
+    Parses a HURDAT2 text file into a structured array with one row per fix
+    :param filePath: the file path for the hurdat file
+    :return: a structured array with hurdatDtype fields
+    """
+    with open(filePath, mode='r') as f:
+        lines = f.readlines()
+
+    rows = []
+    stormNum, stormName = -1, ''
     for line in lines:
-        # turn line into list
-        line = line.replace(' ', '').split(',')[:-1]
-        # if new storm, append previous stormName/stormData to allData and clear stormData
-        if len(line) == 3:
-            allData.append([stormName, stormData])
-            stormName = line[0]
-            stormData = []
-        # add data to stormData
-        else:
-            stormData.append(line[:7])
-
-    # append last stormName/stormData to allData and remove first (empty) element
-    allData.append([stormName, stormData])
-    allData = allData[1:]
-    return allData[1:]
-
-
-def getStormAce(hurData, hurMonths):
-    # slice all data prior to 1970
-    hurNames = [storm[0] for storm in hurData]
-    hurData = hurData[hurNames.index('AL011970'):]
-
-    # calculate ACE for all valid data points and add them up for each storm
-    stormAce = []
-    for storm in hurData:
-        currAce = 0
-        for stormData in storm[1]:
-            if stormData[1] in ['0000', '0600', '1200', '1800'] and stormData[3] in ['TS', 'HU', 'SS'] \
-                    and int(stormData[6]) >= 34 and int((stormData[0])[4:6]) in hurMonths:
-                currAce += int(stormData[6]) * int(stormData[6]) / 10000
-            if float(stormData[4][:-1]) < 13 and float(stormData[5][:-1]) > 87:
-                break
-        stormAce.append([storm[0], currAce])
-    return stormAce
+        line = line.replace(' ', '').split(',')
+        # header lines start a new storm
+        if len(line) < 8:
+            if line[0]:
+                stormNum += 1
+                stormName = line[0]
+            continue
+
+        date, time, status, lat, lon, wind = line[0], line[1], line[3], line[4], line[5], line[6]
+        rows.append((stormNum, stormName, int(stormName[-4:]), int(date[:4]), int(date[4:6]), int(date[6:8]),
+                     int(time[:2]), int(time[2:4]), status, float(lat[:-1]) * (-1 if lat[-1] == 'S' else 1),
+                     float(lon[:-1]) * (-1 if lon[-1] == 'W' else 1), int(wind)))
+    return np.array(rows, dtype=hurdatDtype)
+
+
+@Instrumentation.timed('hurdat load')
+def loadHurdat(filePath, cacheDir=None):
+    """
+    Gets the parsed HURDAT2 fixes, reusing a binary cache of the parsed file while the file's size and mtime are
+    unchanged
+    :param filePath: the file path for the hurdat file
+    :param cacheDir: the directory that the cache is stored in, defaults to the hurdat file's directory
+    :return: a structured array with hurdatDtype fields
+    """
+    if cacheDir is None:
+        cacheDir = os.path.dirname(os.path.abspath(filePath))
+    fileStat = os.stat(filePath)
+    fileKey = hashlib.blake2b(f"{fileStat.st_size}-{fileStat.st_mtime_ns}-{hurdatDtype}".encode(),
+                              digest_size=8).hexdigest()
+    cachePrefix = os.path.basename(filePath) + '.'
+    cachePath = os.path.join(cacheDir, cachePrefix + fileKey + '.npy')
+    if os.path.exists(cachePath):
+        return np.load(cachePath)
+
+    # parse the text file and replace any cache built from an older version of it
+    track = parseHurdat(filePath)
+    for fileName in os.listdir(cacheDir):
+        if fileName.startswith(cachePrefix) and fileName.endswith('.npy'):
+            os.remove(os.path.join(cacheDir, fileName))
+    np.save(cachePath, track)
+    return track
+
+
+def getAceMask(track):
+    """
+    Finds the fixes that meet the requirements for ACE calculation
+    :param track: a structured array of hurdat fixes
+    :return: a boolean array that is True for every fix that counts towards ACE
+    """
+    synoptic = (track['minute'] == 0) & (track['hour'] % 6 == 0)
+    return synoptic & np.isin(track['status'], ['TS', 'HU', 'SS']) & (track['wind'] >= 34)
+
+
+def getCutoffMask(track):
+    """
+    Finds the fixes of each storm up to and including its first fix south of 13N and west of 87W, after which the storm
+    is considered to have moved into the East Pacific
+    :param track: a structured array of hurdat fixes
+    :return: a boolean array that is True for every fix before the East Pacific cutoff
+    """
+    cutoff = (track['lat'] < 13) & (track['lon'] < -87)
+    priorCutoffs = np.cumsum(cutoff) - cutoff
+    stormStarts = np.searchsorted(track['storm'], track['storm'])
+    return priorCutoffs - priorCutoffs[stormStarts] == 0
+
+
+def getFixAce(track):
+    """
+    Calculates the ACE contributed by each fix, with the ACE requirements and East Pacific cutoff applied
+    :param track: a structured array of hurdat fixes
+    :return: an array with the ACE of each fix
+    """
+    wind = track['wind'].astype(float)
+    return np.where(getAceMask(track) & getCutoffMask(track), wind * wind / 10000, 0)
+
+
+def getStormAce(track, hurMonths):
+    """
+    Calculates the ACE of every storm from firstSeason-present for the chosen month(s). Nothing in the pipeline uses it,
+    but it is kept as public API for per-storm ACE
+    :param track: a structured array of hurdat fixes
+    :param hurMonths: the months that ACE is calculated for
+    :return: a list of [storm id, ACE] for each storm
+    """
+    fixAce = np.where(np.isin(track['month'], list(hurMonths)), getFixAce(track), 0)
+    stormIds, stormIndex = np.unique(track['storm'], return_index=True)
+    stormAce = np.bincount(track['storm'] - stormIds[0], weights=fixAce)[stormIds - stormIds[0]]
+    stormNames = track['stormId'][stormIndex]
+    keep = track['stormYear'][stormIndex] >= firstSeason
+    return [[name, ace] for name, ace in zip(stormNames[keep], stormAce[keep])]
+
+
+def getSeasonYears(track):
+    """
+    Gets the seasons from firstSeason through the last season in the hurdat file
+    :param track: a structured array of hurdat fixes
+    :return: an array of years
+    """
+    return np.arange(firstSeason, np.max(track['stormYear']) + 1)
+
+
+def getAceTable(track, years):
+    """
+    Calculates the ACE for every year and month in one pass. Storms are counted in the year they are named for
+    :param track: a structured array of hurdat fixes
+    :param years: the years that ACE is calculated for
+    :return: an array of ACE values with shape (year, month)
+    """
+    years = np.asarray(years)
+    yearIndex = np.searchsorted(years, track['stormYear'])
+    valid = np.isin(track['stormYear'], years)
+    bins = yearIndex[valid] * 12 + track['month'][valid] - 1
+    aceTable = np.bincount(bins, weights=getFixAce(track)[valid], minlength=len(years) * 12)
+    return np.reshape(aceTable, (len(years), 12))
+
+
+def sumMonthAce(aceTable, hurMonths):
+    """
+    Adds up the ACE of the chosen month(s) for each year of an ACE table
+    :param aceTable: an array of ACE values with shape (year, month)
+    :param hurMonths: the months that ACE is added up for
+    :return: an array with the ACE of each year
+    """
+    return np.round(np.sum(aceTable[:, np.array(list(hurMonths)) - 1], axis=1), 2)
 
 
 def getMonthAce(hurMonths):
-    # get ACE for each storm that occurs in the chosen month(s)
-    allHurdatData = getHurdatData('C:/Nikhil Stuff/Coding Stuff/hurdatdata.txt')
-    stormAce = getStormAce(allHurdatData, hurMonths)
-
-    # get names and years of all storms from 1970-present
-    names = [storm[0] for storm in allHurdatData]
-    names = names[names.index('AL011970'):]
-    names.append('AL012023')
-    stormYears = [storm[-4:] for storm in names]
-
-    allAce = []
-    for year in range(1970, 2024):
-        # get list of storms for the given year
-        seasonAce = stormAce[stormYears.index(str(year)):]
-        tempYears = stormYears[stormYears.index(str(year)):]
-        num = 0
-        while num < len(tempYears) and int(tempYears[num]) == year:
-            num += 1
-        seasonAce = seasonAce[:num]
-
-        # add up ACE for each storm in the given year
-        seasonAce = np.sum(np.array(seasonAce)[:, 1].astype(float))
-        allAce.append([year, np.round(seasonAce, 2)])
-
-    return allAce
+    """
+    Calculates the ACE of each year from firstSeason through the last season in the hurdat file for the chosen
+    month(s). The pipeline uses getAceTable directly, but this is kept as public API for a single season's ACE series
+    :param hurMonths: the months that ACE is calculated for
+    :return: a list of [year, ACE] for each year
+    """
+    track = loadHurdat(hurdatPath)
+    years = getSeasonYears(track)
+    seasonAce = sumMonthAce(getAceTable(track, years), hurMonths)
+    return [[year, ace] for year, ace in zip(years.tolist(), seasonAce.tolist())]
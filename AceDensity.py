@@ -0,0 +1,41 @@
+import numpy as np
+import AceCalculator
+import Instrumentation
+
+densityRange = ([-120, 0], [0, 60])  # longitude and latitude extent of the density maps
+densityBins = [20, 10]  # number of longitude and latitude bins
+
+
+@Instrumentation.timed('histogramming')
+def getDensityCube(track, years, binRange=densityRange, bins=densityBins):
+    """
+    Bins the ACE of every fix that meets the requirements for ACE calculation into a map for each year in one pass
+    :param track: a structured array of hurdat fixes
+    :param years: the years that maps are calculated for
+    :param binRange: the [lon min, lon max] and [lat min, lat max] of the maps
+    :param bins: the number of longitude and latitude bins
+    :return: an array of ACE density maps with shape (year, lon bin, lat bin)
+    """
+    years = np.asarray(years)
+    fixes = track[AceCalculator.getAceMask(track) & np.isin(track['year'], years)]
+    wind = fixes['wind'].astype(float)
+
+    yearIndex = np.searchsorted(years, fixes['year'])
+    sample = np.column_stack([yearIndex, fixes['lon'], fixes['lat']])
+    cubeRange = [(-0.5, len(years) - 0.5), binRange[0], binRange[1]]
+    densityCube = np.histogramdd(sample, bins=[len(years)] + list(bins), range=cubeRange, weights=wind * wind / 10000)
+    return Instrumentation.noteArray(densityCube[0])
+
+
+def getCompositeAnomaly(densityCube, years, analogYears, weights=None):
+    """
+    Calculates the (weighted) average ACE density map of the analog years minus the average map of all years
+    :param densityCube: an array of ACE density maps with shape (year, lon bin, lat bin)
+    :param years: the years of the maps in densityCube
+    :param analogYears: the years to be averaged
+    :param weights: the weight of each analog year, defaults to equal weights
+    :return: the ACE density anomaly map with shape (lon bin, lat bin)
+    """
+    analogIndex = np.searchsorted(np.asarray(years), analogYears)
+    analogHist = np.average(densityCube[analogIndex], axis=0, weights=weights)
+    return analogHist - np.mean(densityCube, axis=0)
@@ -0,0 +1,234 @@
+import itertools
+import json
+from multiprocessing import Pool
+import numpy as np
+import xarray as xr
+import AceCalculator
+import AceDensity
+import AnalogFinder
+import AnomalyCache
+import Instrumentation
+
+# configurations swept by the evaluation, every combination of these is scored
+variableSets = [["sst"], ["sst", "uwndup", "uwndlow", "stab"]]  # variables to be included in each analog set
+monthWindows = [range(6, 10), range(1, 10)]  # months that are used for each variable
+analogThresholds = [5, 7, 10]  # number of analogs in the set
+evalYears = None  # years that are held out in turn and can be considered as analogs, None for AnalogFinder's
+seasonMonths = range(1, 13)  # months of ACE that make up the predicted season
+pixelChunk = 100000  # number of pixels whose sums are calculated at once, which bounds memory use
+
+
+def getBlockStats(unit):
+    """
+    Calculates the sums that the leave-one-year-out pattern correlations of one (variable, month) block are built
+    from, for every held-out year at once. Holding out a year changes the climatology of each pixel, which shifts and
+    rescales its z-scores, so a year's features are c * z - d, where z is its z-score from all years and c and d depend
+    on the pixel and the held-out year. Every sum over pixels then takes a few matrix products with z
+    :param unit: the file path of the block's cached (not latitude-weighted) anomalies, the month of the block, the
+    years that are evaluated, and whether to hold years out of the climatology
+    :return: the number of features, and arrays with shape (held-out year, year) of the sum of each year's features,
+    the sum of their squares, and the sum of their products with the held-out year's features
+    """
+    anomPath, month, years, leaveOut = unit
+    with xr.open_dataarray(anomPath) as anomData:
+        monthData = anomData.sel(time=anomData['time.month'] == month)
+        numClimoYears = monthData.sizes['time']
+        zscores = monthData.sel(time=monthData['time.year'].isin(list(years))).sortby('time')
+        weights = np.cos(np.radians(anomData.latitude.values))[:, np.newaxis] * np.ones(anomData.shape[2])
+        zscores = np.reshape(zscores.values, (len(years), -1))
+    weights = weights.flatten()
+    numFeatures = zscores.shape[1]
+
+    sums, sumSqs, crossSums = (np.zeros((len(years), len(years))) for _ in range(3))
+    for start in range(0, numFeatures, pixelChunk):
+        chunkZscores, chunkWeights = zscores[:, start:start + pixelChunk], weights[start:start + pixelChunk]
+
+        # land (NaN) and constant pixels are zero features, same as AnalogFinder.buildFeatureMatrix
+        validPixels = np.all(np.isfinite(chunkZscores), axis=0)
+        chunkZscores = np.where(validPixels, chunkZscores, 0)
+        chunkWeights = np.where(validPixels, chunkWeights, 0)
+        if leaveOut:
+            # z-scores have mean 0 and variance 1 over all years, so each climatology without a year follows from
+            # that year's z-scores
+            shift = -chunkZscores / (numClimoYears - 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = chunkWeights / np.sqrt((numClimoYears - chunkZscores ** 2) / (numClimoYears - 1) - shift ** 2)
+            scale = np.nan_to_num(scale, posinf=0)
+            offset = scale * shift
+        else:
+            scale = np.tile(chunkWeights, (len(years), 1))
+            offset = np.zeros_like(scale)
+
+        heldFeatures = scale * chunkZscores - offset
+        sums += scale @ chunkZscores.T - np.sum(offset, axis=1)[:, np.newaxis]
+        sumSqs += ((scale ** 2) @ (chunkZscores ** 2).T - 2 * (scale * offset) @ chunkZscores.T +
+                   np.sum(offset ** 2, axis=1)[:, np.newaxis])
+        crossSums += (heldFeatures * scale) @ chunkZscores.T - np.sum(heldFeatures * offset, axis=1)[:, np.newaxis]
+    return numFeatures, sums, sumSqs, crossSums
+
+
+@Instrumentation.timed('block statistics')
+def computeBlockStats(variables, months, years, leaveOut=True, processes=None):
+    """
+    Calculates the leave-one-year-out sums of every (variable, month) block across a process pool, from the cached
+    anomalies of each variable
+    :param variables: the variables to be included
+    :param months: the months to be included
+    :param years: the years that are evaluated
+    :param leaveOut: whether to hold each year out of the climatology
+    :param processes: the number of worker processes, defaults to the number of cores
+    :return: a dictionary with the sums of each (variable, month) block
+    """
+    units, blocks = [], []
+    for var in variables:
+        varPath = AnalogFinder.varDir + var + 'EraModified.nc'
+        anomData = AnomalyCache.getAnomalies(varPath, AnalogFinder.varDict[var], months, AnalogFinder.cacheDir,
+                                             weightLatitude=False)
+        anomPath = anomData.encoding['source']
+        anomData.close()
+        for month in months:
+            units.append((anomPath, month, list(years), leaveOut))
+            blocks.append((var, month))
+
+    with Pool(processes) as pool:
+        return dict(zip(blocks, pool.map(getBlockStats, units)))
+
+
+def getLooCorrelations(blockStats, variables, months, weights=None):
+    """
+    Combines block sums into the pattern correlation of every year with every other year, with each row using the
+    climatology without its own year
+    :param blockStats: a dictionary with the sums of each (variable, month) block
+    :param variables: the variables to be included in the analog set
+    :param months: the months that are used for each variable
+    :param weights: a dictionary with the weight of each variable, defaults to equal weights
+    :return: an array of pattern correlations with shape (held-out year, year)
+    """
+    if weights is None:
+        weights = {}
+    numFeatures, sums, sumSqs, crossSums = 0, 0, 0, 0
+    for var, month in itertools.product(variables, months):
+        blockFeatures, blockSums, blockSumSqs, blockCrossSums = blockStats[(var, month)]
+        weight = weights.get(var, 1.0)
+        numFeatures += blockFeatures
+        sums = sums + np.sqrt(weight) * blockSums
+        sumSqs = sumSqs + weight * blockSumSqs
+        crossSums = crossSums + weight * blockCrossSums
+
+    heldSums, heldSumSqs = np.diag(sums)[:, np.newaxis], np.diag(sumSqs)[:, np.newaxis]
+    covariance = numFeatures * crossSums - heldSums * sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance / np.sqrt((numFeatures * heldSumSqs - heldSums ** 2) * (numFeatures * sumSqs - sums ** 2))
+
+
+def hindcastConfig(looCorrs, years, k, seasonAce, densityCube):
+    """
+    Predicts the seasonal ACE and ACE density anomaly of every held-out year from its analogs
+    :param looCorrs: an array of leave-one-year-out pattern correlations with shape (held-out year, year)
+    :param years: the years of the rows and columns of looCorrs
+    :param k: the number of analogs in the set
+    :param seasonAce: the seasonal ACE of each year
+    :param densityCube: an array of ACE density maps with shape (year, lon bin, lat bin)
+    :return: the predicted and climatological seasonal ACE of each year, and the predicted and observed ACE density
+    anomaly maps of each year
+    """
+    years = np.asarray(years)
+    predAce, climoAce = np.zeros(len(years)), np.zeros(len(years))
+    predDensity, obsDensity = np.zeros(densityCube.shape), np.zeros(densityCube.shape)
+    for num, year in enumerate(years):
+        # the climatology of a held-out year is based off every other year
+        others = years != year
+        climoAce[num] = np.mean(seasonAce[others])
+        climoDensity = np.mean(densityCube[others], axis=0)
+        obsDensity[num] = densityCube[num] - climoDensity
+
+        # weight analogs by their correlations, falling back to the climatology if there are none
+        analogs = AnalogFinder.rankAnalogs(looCorrs[num], years, year)[:k]
+        if not len(analogs):
+            predAce[num] = climoAce[num]
+            continue
+        weights = analogs[:, 1] if np.sum(analogs[:, 1]) > 0 else None
+        analogIndex = np.searchsorted(years, analogs[:, 0])
+        predAce[num] = np.average(seasonAce[analogIndex], weights=weights)
+        predDensity[num] = np.average(densityCube[analogIndex], axis=0, weights=weights) - climoDensity
+    return predAce, climoAce, predDensity, obsDensity
+
+
+def scoreHindcasts(predAce, climoAce, obsAce, predDensity, obsDensity):
+    """
+    Scores hindcasts of seasonal ACE and ACE density anomalies against the observed values
+    :param predAce: the predicted seasonal ACE of each year
+    :param climoAce: the climatological seasonal ACE of each year
+    :param obsAce: the observed seasonal ACE of each year
+    :param predDensity: the predicted ACE density anomaly map of each year
+    :param obsDensity: the observed ACE density anomaly map of each year
+    :return: a dictionary of scores, where skill scores compare the mean squared error against the climatology's
+    """
+    aceErrors = predAce - obsAce
+    predMaps = np.reshape(predDensity, (len(predDensity), -1))
+    obsMaps = np.reshape(obsDensity, (len(obsDensity), -1))
+    predMaps = predMaps - np.mean(predMaps, axis=1, keepdims=True)
+    obsMaps = obsMaps - np.mean(obsMaps, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mapCorrs = np.sum(predMaps * obsMaps, axis=1) / (np.linalg.norm(predMaps, axis=1) *
+                                                         np.linalg.norm(obsMaps, axis=1))
+    return dict(aceMae=float(np.mean(np.abs(aceErrors))), aceRmse=float(np.sqrt(np.mean(aceErrors ** 2))),
+                aceCorr=float(np.corrcoef(predAce, obsAce)[0, 1]),
+                aceSkill=float(1 - np.mean(aceErrors ** 2) / np.mean((climoAce - obsAce) ** 2)),
+                densityCorr=float(np.nanmean(mapCorrs)),
+                densitySkill=float(1 - np.sum((predDensity - obsDensity) ** 2) / np.sum(obsDensity ** 2)))
+
+
+def getConfigGrid(variableSets, monthWindows, analogThresholds):
+    """
+    Creates every combination of variable set, month window, and number of analogs
+    :param variableSets: the variable sets to be swept
+    :param monthWindows: the month windows to be swept
+    :param analogThresholds: the numbers of analogs to be swept
+    :return: a list of configuration dictionaries
+    """
+    return [dict(variables=list(variables), months=list(months), k=k)
+            for variables, months, k in itertools.product(variableSets, monthWindows, analogThresholds)]
+
+
+def evaluateGrid(configs, years=evalYears, leaveOut=True, processes=None):
+    """
+    Runs leave-one-year-out hindcasts of every year for every configuration and scores them. The sums of each
+    (variable, month) block are calculated once and shared by every configuration that uses the block, as are the
+    HURDAT data and ACE density maps
+    :param configs: a list of configuration dictionaries with the variables, months, number of analogs k, and
+    optionally weights of each variable
+    :param years: the years that are held out in turn, and that can be considered as analogs, defaults to
+    AnalogFinder.getPossAnalogs()
+    :param leaveOut: whether to hold each year out of the climatology, False reproduces AnalogFinder.hindcastAnalogs
+    :param processes: the number of worker processes, defaults to the number of cores
+    :return: a list with the configuration and scores of each configuration
+    """
+    if years is None:
+        years = AnalogFinder.getPossAnalogs()
+    years = sorted(years)
+    variables = list(dict.fromkeys(var for config in configs for var in config['variables']))
+    months = sorted(set(month for config in configs for month in config['months']))
+    blockStats = computeBlockStats(variables, months, years, leaveOut, processes)
+
+    track = AceCalculator.loadHurdat(AceCalculator.hurdatPath)
+    seasonAce = AceCalculator.getAceTable(track, years)[:, np.array(seasonMonths) - 1].sum(axis=1)
+    densityCube = AceDensity.getDensityCube(track, years)
+
+    results = []
+    for config in configs:
+        looCorrs = getLooCorrelations(blockStats, config['variables'], config['months'], config.get('weights'))
+        predAce, climoAce, predDensity, obsDensity = hindcastConfig(looCorrs, years, config['k'], seasonAce,
+                                                                    densityCube)
+        results.append(dict(config, **scoreHindcasts(predAce, climoAce, seasonAce, predDensity, obsDensity)))
+    return results
+
+
+if __name__ == '__main__':
+    evalResults = evaluateGrid(getConfigGrid(variableSets, monthWindows, analogThresholds))
+    for evalResult in sorted(evalResults, key=lambda result: result['aceSkill'], reverse=True):
+        print(f"{evalResult['variables']} months {evalResult['months'][0]}-{evalResult['months'][-1]} "
+              f"k={evalResult['k']}: ACE skill {evalResult['aceSkill']:.3f}, ACE corr {evalResult['aceCorr']:.3f}, "
+              f"density skill {evalResult['densitySkill']:.3f}, density corr {evalResult['densityCorr']:.3f}")
+    with open('evalResults.json', mode='w') as f:
+        json.dump(evalResults, f, indent=1)
@@ -1,158 +1,220 @@
-import xarray as xr
 import numpy as np
-from scipy.stats import pearsonr
-import cartopy.crs as ccrs
-import cartopy.feature as cf
-import matplotlib.pyplot as plt
+import xarray as xr
 import AceCalculator
+import AceDensity
+import AnomalyCache
+import AnomalyCalculator
+import Instrumentation
+import MapRenderer
 
 variables = ["sst", "uwndup", "uwndlow", "stab"]  # variables to be included in analog set
 year = 2012  # year to calculate analogs for
 months = range(1, 10)  # stores month that is used for each variable
-possAnalogs = range(1970, 2024)  # stores years that can be considered as analogs
+possAnalogs = None  # stores years that can be considered as analogs, None for every season in the hurdat file
 analogThresh = 7  # number of analogs in the set
+hindcast = False  # also calculate and print the analogs for every year in possAnalogs
+streaming = False  # score analogs out-of-core, one chunk of times at a time, for data too large to fit in memory
+timeChunk = 12  # number of times loaded at once in streaming mode
+varDir = 'C:/Nikhil Stuff/Coding Stuff/variablefiles/'  # stores the variable files
+cacheDir = varDir + 'anomcache/'  # stores preprocessed anomaly fields
+corrDir = varDir + 'NAcorrs/'  # stores the correlation maps between each variable and ACE
 
 # dictionary for conversions
 varDict = {"sst": "sst", "mslp": "msl", "hgtmid": "z", "shummid": "q", "uwndup": "u", "uwndlow": "u", "stab": "ss"}
 
 
-def zscoreThing(data):
-    """
-    Normalizes variable data to account for different amounts of variability in different regions
-    :param data: the variable DataArray to be normalized
-    :return: the normalized variable DataArray
-    """
-    # calculate mean/standard deviation maps for each month
-    month_groups = data.groupby('time.month')
-    allMeans = month_groups.mean(dim='time')
-    allStds = month_groups.std(dim='time')
-
-    # use appropriate mean/std maps to calculate z-score map for each time
-    month_zscores = []
-    for mon in set(data['time.month'].to_numpy()):
-        mask = data['time.month'] == mon
-        zscoreMap = (data.sel(time=mask) - allMeans.sel(month=mon)) / allStds.sel(month=mon)
-        month_zscores.append(zscoreMap.drop_vars('month'))
-
-    # concat z-score data for each month and return
-    zscore_data = xr.concat(month_zscores, dim='time')
-    return zscore_data
-
-
-currDataList, analogDataList, corrDataList = [], [], []  # stores analog set for each variable
-
-# loop through each variable
-for var in range(len(variables)):
-    # get climo map for the given month
-    varPath = 'C:/Nikhil Stuff/Coding Stuff/variablefiles/' + variables[var] + 'EraModified.nc'
-    varDataset = xr.open_dataset(varPath)
-    varData = varDataset[varDict[variables[var]]]
-    varData = zscoreThing(varData)
-
-    corrPath = 'C:/Nikhil Stuff/Coding Stuff/variablefiles/NAcorrs/' + variables[var] + 'EraCorr.nc'
-    corrDataset = xr.open_dataset(corrPath)
-    corrMask = (corrDataset['time.month'] >= months[0]) & (corrDataset['time.month'] <= months[-1])
-    corrData = corrDataset.allAce.sel(time=corrMask)
-    corrData = np.multiply(corrData, np.cos(np.radians(corrData.latitude)))
-    corrDataList.append(corrData)
-
-    monthMask = (varData['time.month'] >= months[0]) & (varData['time.month'] <= months[-1])
-    yearMask = (varData['time.year'] >= possAnalogs[0]) & (varData['time.year'] <= possAnalogs[-1])
-
-    currData = varData.sel(time=(varData["time.year"] == year) & monthMask)
-    currData = np.multiply(currData, np.cos(np.radians(currData.latitude)))
-    currDataList.append(currData)
-
-    analogData = varData.sel(time=yearMask & monthMask)
-    analogData = np.multiply(analogData, np.cos(np.radians(analogData.latitude)))
-    analogDataList.append(analogData)
-
-corrFlat = np.array(corrDataList).flatten()
-currFlat = np.array(currDataList).flatten()
-currFlat = np.nan_to_num(currFlat)
-
-scores = []
-for possAnalog in possAnalogs:
-    analogData = np.array([var.sel(time=var['time.year'] == possAnalog) for var in analogDataList])
-    analogFlat = analogData.flatten()
-    analogFlat = np.nan_to_num(analogFlat)
-
-    # calculate correlation between maps and append to scores
-    correlation = pearsonr(analogFlat, currFlat)[0]
-    scores.append([possAnalog, correlation])
-
-# add up differences for each year and sort them into a final list of analogs
-scores = np.array(scores)
-scores = scores[np.flip(scores[:, 1].argsort())]
-scores[:, 1] = np.round(scores[:, 1], 3)
-if year != 2024:
-    scores = scores[1:]
-
-# store the sorted analog list and move onto the next hindcast year
-scores = scores[scores[:, 1] >= 0]
-print(f"{year}: {scores.tolist()}")
-
-# get hurdat data from 1851-present
-allHurdatData = AceCalculator.getHurdatData('C:/Nikhil Stuff/Coding Stuff/hurdatdata.txt')
-allHurdatData = [storm[1] for storm in allHurdatData]
-
-diffHists = []
-for analog in scores[:, 0]:
-    # store data for coordinates and ACE for all years and analog years in lists
-    allX, allY, allAce = [], [], []
-    analogX, analogY, analogAce = [], [], []
-
-    # loop through every line of data
-    for storm in allHurdatData:
-        for stormData in storm:
-            # only include data if it meets the requirements for ACE calculation
-            if stormData[1] in ['0000', '0600', '1200', '1800'] and stormData[3] in ['TS', 'HU', 'SS'] \
-                    and int(stormData[6]) >= 34 and int(stormData[0][:4]) >= 1970:
-                allX.append(float(stormData[5][:-1]) * -1)
-                allY.append(float(stormData[4][:-1]))
-                allAce.append(int(stormData[6]) * int(stormData[6]) / 10000)
-
-                # append to analog lists if the data falls under one of those years
-                if int(stormData[0][:4]) == analog:
-                    analogX.append(float(stormData[5][:-1]) * -1)
-                    analogY.append(float(stormData[4][:-1]))
-                    analogAce.append(int(stormData[6]) * int(stormData[6]) / 10000)
-
-    # calculate histograms for all data and analog data and then subtract to get the anomaly
-    allHist2d = np.histogram2d(allX, allY, bins=[20, 10], weights=allAce, range=([-120, 0], [0, 60]))
-    analogHist2d = np.histogram2d(analogX, analogY, bins=[20, 10], weights=analogAce, range=([-120, 0], [0, 60]))
-    diffHist = analogHist2d[0] - allHist2d[0] / 54
-    diffHists.append(diffHist)
-
-scores[:, 1] /= sum(scores[:, 1])
-diffHists = np.array(diffHists)
-diffHist = np.average(diffHists, axis=0, weights=scores[:, 1])
-
-# plot cartopy map and various features
-plt.figure(figsize=(12, 6))
-ax = plt.axes(projection=ccrs.PlateCarree())
-ax.add_feature(cf.LAND)
-ax.add_feature(cf.STATES, linewidth=0.2, edgecolor="gray")
-ax.add_feature(cf.BORDERS, linewidth=0.3)
-ax.coastlines(linewidth=0.5, resolution='50m')
-
-# plot gridlines
-gl = ax.gridlines(crs=ccrs.PlateCarree(central_longitude=0), draw_labels=True, linewidth=1, color='gray', alpha=0.5,
-                  linestyle='--')
-gl.top_labels = gl.right_labels = False
-gl.xlabel_style = {'size': 7, 'weight': 'bold', 'color': 'gray'}
-gl.ylabel_style = {'size': 7, 'weight': 'bold', 'color': 'gray'}
-
-# add data and colormap
-plt.imshow(diffHist.T, interpolation='gaussian', cmap='RdBu_r', origin='lower', extent=[-120, 0, 0, 60],
-           vmin=-3, vmax=3)
-ax.set_extent([-100, -5, 5, 50])
-cbar = plt.colorbar(pad=0.015, aspect=27, shrink=0.99, extend='both')
-cbar.ax.tick_params(labelsize=7)
-
-mainTitle = f"Weighted ACE Density Anomaly of All Analogs"
-plt.title(f"{mainTitle} \nYear: {year}", fontsize=9, weight='bold', loc='left')
-plt.title("DCAreaWx", fontsize=9, weight='bold', loc='right', color='gray')
-
-plt.savefig(r"C:/Nikhil Stuff/Coding Stuff/AceAnomMap.png", dpi=300, bbox_inches='tight')
-plt.show()
+def loadAnomalies(variables, months):
+    """
+    Gets the latitude-weighted z-score maps of each variable for the given months
+    :param variables: the variables to be included in the analog set
+    :param months: the months that are used for each variable
+    :return: a list with the anomaly DataArray for each variable
+    """
+    anomList = []
+    for var in variables:
+        # reuse cached anomalies when the source file is unchanged
+        varPath = varDir + var + 'EraModified.nc'
+        anomList.append(AnomalyCache.getAnomalies(varPath, varDict[var], months, cacheDir))
+    return anomList
+
+
+@Instrumentation.timed('feature packing')
+def buildFeatureMatrix(anomList, years):
+    """
+    Packs the anomaly maps of every variable and month into one row per year
+    :param anomList: a list with the anomaly DataArray for each variable
+    :param years: the years that rows are built for
+    :return: an array of flattened anomaly maps with shape (year, feature)
+    """
+    features = []
+    for anomData in anomList:
+        varData = anomData.sel(time=anomData['time.year'].isin(list(years))).sortby('time')
+        varData = varData.values.reshape(len(years), -1)
+        features.append(np.nan_to_num(varData))
+    return Instrumentation.noteArray(np.concatenate(features, axis=1))
+
+
+@Instrumentation.timed('candidate scoring')
+def correlationMatrix(features):
+    """
+    Calculates the pattern correlation between every pair of rows with a single matrix product
+    :param features: an array of flattened anomaly maps with shape (year, feature)
+    :return: an array of pattern correlations with shape (year, year)
+    """
+    features = features - np.mean(features, axis=1, keepdims=True)
+    features = features / np.linalg.norm(features, axis=1, keepdims=True)
+    return features @ features.T
+
+
+def rankAnalogs(yearScores, years, targetYear):
+    """
+    Sorts the possible analogs for a year by pattern correlation
+    :param yearScores: the pattern correlation between the target year and each year in years
+    :param years: the years that can be considered as analogs
+    :param targetYear: the year that analogs are calculated for, which is excluded from its own analogs
+    :return: an array of [analog year, correlation] rows sorted from best to worst, with negative correlations removed
+    """
+    scores = np.column_stack([years, yearScores])
+    scores = scores[scores[:, 0] != targetYear]
+    scores = scores[np.flip(scores[:, 1].argsort(kind='stable'))]
+    scores[:, 1] = np.round(scores[:, 1], 3)
+    return scores[scores[:, 1] >= 0]
+
+
+def getPossAnalogs():
+    """
+    Gets the years that can be considered as analogs, which default to every season in the hurdat file so that new
+    seasons are picked up without editing possAnalogs
+    :return: a list of years
+    """
+    if possAnalogs is not None:
+        return list(possAnalogs)
+    return AceCalculator.getSeasonYears(AceCalculator.loadHurdat(AceCalculator.hurdatPath)).tolist()
+
+
+def findAnalogs(variables, months, targetYear, possAnalogs):
+    """
+    Calculates the analogs for a single year
+    :param variables: the variables to be included in the analog set
+    :param months: the months that are used for each variable
+    :param targetYear: the year that analogs are calculated for
+    :param possAnalogs: the years that can be considered as analogs
+    :return: an array of [analog year, correlation] rows sorted from best to worst
+    """
+    years = sorted(set(possAnalogs) | {targetYear})
+    corrMatrix = correlationMatrix(buildFeatureMatrix(loadAnomalies(variables, months), years))
+    analogMask = np.isin(years, list(possAnalogs))
+    return rankAnalogs(corrMatrix[years.index(targetYear), analogMask], np.array(years)[analogMask], targetYear)
+
+
+def hindcastAnalogs(variables, months, possAnalogs):
+    """
+    Calculates the analogs for every possible analog year in one pass, e.g. for hindcast verification
+    :param variables: the variables to be included in the analog set
+    :param months: the months that are used for each variable
+    :param possAnalogs: the years that analogs are calculated for and that can be considered as analogs
+    :return: a dictionary with an array of [analog year, correlation] rows for each year
+    """
+    years = list(possAnalogs)
+    corrMatrix = correlationMatrix(buildFeatureMatrix(loadAnomalies(variables, months), years))
+    return {targetYear: rankAnalogs(corrMatrix[num], years, targetYear) for num, targetYear in enumerate(years)}
+
+
+@Instrumentation.timed('streaming analog search')
+def streamAnalogs(variables, months, targetYear, possAnalogs, timeChunk=timeChunk):
+    """
+    Calculates the analogs for a single year without loading whole variables into memory. Variables are read in
+    chunks of times and each candidate's correlation is built up from running dot products and sums, so memory is
+    bounded by one chunk plus the target year's maps
+    :param variables: the variables to be included in the analog set
+    :param months: the months that are used for each variable
+    :param targetYear: the year that analogs are calculated for
+    :param possAnalogs: the years that can be considered as analogs
+    :param timeChunk: the number of times loaded at once
+    :return: an array of [analog year, correlation] rows sorted from best to worst
+    """
+    years = np.array(possAnalogs)
+    monthList = list(months)
+    numFeatures, targetSum, targetSumSq = 0, 0.0, 0.0
+    dots, sums, sumSqs, counts = (np.zeros(len(years)) for _ in range(4))
+
+    for var in variables:
+        varData = xr.open_dataset(varDir + var + 'EraModified.nc', chunks={'time': timeChunk})[varDict[var]]
+
+        # calculate mean/stdev maps for each month in one pass over the data
+        monthGroups = varData.groupby('time.month')
+        climo = xr.Dataset(dict(mean=monthGroups.mean(dim='time'), std=monthGroups.std(dim='time'))).compute()
+
+        # the target year's maps are the only ones kept in memory
+        targetData = varData.sel(time=(varData['time.year'] == targetYear) & varData['time.month'].isin(monthList))
+        targetData = targetData.load()
+        targetMonths = list(targetData['time.month'].values)
+        targetMaps = AnomalyCalculator.standardizeMaps(targetData.values, climo['mean'].sel(month=targetMonths).values,
+                                                       climo['std'].sel(month=targetMonths).values,
+                                                       targetData.latitude.values)
+        targetMaps = np.reshape(targetMaps, (len(targetMaps), -1))
+        numFeatures += targetMaps.size
+        targetSum += np.sum(targetMaps)
+        targetSumSq += np.sum(targetMaps ** 2)
+
+        # stream the candidate years through in chunks, adding each map's contribution to its year's running totals
+        candData = varData.sel(time=varData['time.year'].isin(years) & varData['time.month'].isin(monthList))
+        for start in range(0, candData.sizes['time'], timeChunk):
+            with Instrumentation.stage('dataset read', variable=var):
+                block = candData.isel(time=slice(start, start + timeChunk)).load()
+            blockMonths = block['time.month'].values
+            blockMaps = AnomalyCalculator.standardizeMaps(block.values, climo['mean'].sel(month=blockMonths).values,
+                                                          climo['std'].sel(month=blockMonths).values,
+                                                          block.latitude.values)
+            blockMaps = np.reshape(blockMaps, (len(blockMaps), -1))
+            yearIndex = np.searchsorted(years, block['time.year'].values)
+            targetIndex = [targetMonths.index(mon) for mon in blockMonths]
+
+            np.add.at(dots, yearIndex, np.sum(blockMaps * targetMaps[targetIndex], axis=1))
+            np.add.at(sums, yearIndex, np.sum(blockMaps, axis=1))
+            np.add.at(sumSqs, yearIndex, np.sum(blockMaps ** 2, axis=1))
+            np.add.at(counts, yearIndex, blockMaps.shape[1])
+        varData.close()
+
+    # correlation of each candidate with the target year from the running totals
+    if np.any(counts != numFeatures):
+        raise ValueError("every possible analog must have data for every variable and month")
+    covariance = numFeatures * dots - sums * targetSum
+    variances = (numFeatures * sumSqs - sums ** 2) * (numFeatures * targetSumSq - targetSum ** 2)
+    correlation = covariance / np.sqrt(variances)
+    return rankAnalogs(correlation, years, targetYear)
+
+
+def plotAnalogMap(diffHist, year, savePath):
+    """
+    Plots the weighted ACE density anomaly of a year's analogs. Cartopy and matplotlib are only imported when a map is
+    rendered so that finding analogs never pays their import cost
+    :param diffHist: the ACE density anomaly map with shape (lon bin, lat bin)
+    :param year: the year that the analogs were calculated for
+    :param savePath: the file path that the map is saved to
+    """
+    title = f"Weighted ACE Density Anomaly of All Analogs \nYear: {year}"
+    MapRenderer.renderFigure(MapRenderer.getAceFigure(diffHist, title, savePath, vmax=3))
+
+
+if __name__ == '__main__':
+    analogYears = getPossAnalogs()
+    if hindcast:
+        allScores = hindcastAnalogs(variables, months, analogYears)
+        for hindcastYear, hindcastScores in allScores.items():
+            print(f"{hindcastYear}: {hindcastScores.tolist()}")
+    if hindcast and year in allScores:
+        scores = allScores[year]
+    elif streaming:
+        scores = streamAnalogs(variables, months, year, analogYears)
+        print(f"{year}: {scores.tolist()}")
+    else:
+        scores = findAnalogs(variables, months, year, analogYears)
+        print(f"{year}: {scores.tolist()}")
+
+    # bin the ACE of every year once, then average the analog years weighted by their correlations
+    track = AceCalculator.loadHurdat(AceCalculator.hurdatPath)
+    densityCube = AceDensity.getDensityCube(track, analogYears)
+    diffHist = AceDensity.getCompositeAnomaly(densityCube, analogYears, scores[:, 0], weights=scores[:, 1])
+
+    plotAnalogMap(diffHist, year, r"C:/Nikhil Stuff/Coding Stuff/AceAnomMap.png")
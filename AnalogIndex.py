@@ -0,0 +1,203 @@
+import json
+import os
+import numpy as np
+import AnalogFinder
+import CorrelationStore
+import Instrumentation
+
+
+def loadCorrMap(variable, month, aceTarget='allAce'):
+    """
+    Gets the correlation map between a variable and ACE for a given month
+    :param variable: the variable that the map was calculated for
+    :param month: the month of variable data that the map was calculated for
+    :param aceTarget: the ACE target that the map was calculated for
+    :return: the correlation map, with insignificant correlations set to zero
+    """
+    return CorrelationStore.readCorrMap(AnalogFinder.corrDir + CorrelationStore.storeName, variable, month, aceTarget)
+
+
+def getBlockTransform(variable, month, corrMode, aceTarget, latitude, longitude):
+    """
+    Gets the pixels kept for a block and the weight of each one. The correlation maps must be on the same grid as the
+    block, since pixels are picked by their position in the flattened map
+    :param variable: the variable of the block
+    :param month: the month of the block
+    :param corrMode: 'mask' to keep only pixels with a significant correlation to ACE, or 'weight' to also weight those
+    pixels by the absolute value of their correlation
+    :param aceTarget: the ACE target whose correlation maps are used
+    :param latitude: the latitudes of the block's anomaly maps
+    :param longitude: the longitudes of the block's anomaly maps
+    :return: the indices of the kept pixels and the weight of each one
+    """
+    corrLats, corrLons = CorrelationStore.getStoreGrid(AnalogFinder.corrDir + CorrelationStore.storeName)
+    for name, corrCoords, anomCoords in [('latitude', corrLats, latitude), ('longitude', corrLons, longitude)]:
+        if len(corrCoords) != len(anomCoords) or not np.allclose(corrCoords, anomCoords):
+            raise ValueError(f"the {variable} correlation maps have a different {name} grid than its anomalies "
+                             f"({len(corrCoords)} vs {len(anomCoords)} points); recalculate them on the anomaly grid")
+    corrMap = np.nan_to_num(loadCorrMap(variable, month, aceTarget)).flatten()
+    pixels = np.flatnonzero(corrMap)
+    if corrMode == 'mask':
+        return pixels, np.ones(len(pixels))
+    if corrMode == 'weight':
+        return pixels, np.abs(corrMap[pixels])
+    raise ValueError(f"unknown correlation mode {corrMode}")
+
+
+def fitEofs(blockData, nEofs):
+    """
+    Fits a truncated EOF basis to the maps of a block
+    :param blockData: an array of flattened maps with shape (year, pixel)
+    :param nEofs: the maximum number of EOFs to keep
+    :return: the mean map and an array of EOFs with shape (EOF, pixel)
+    """
+    meanMap = np.mean(blockData, axis=0)
+    eofs = np.linalg.svd(blockData - meanMap, full_matrices=False)[2]
+    return meanMap, eofs[:nEofs]
+
+
+def buildIndex(variables, indexDir, years=None, corrMode=None, aceTarget='allAce', nEofs=None):
+    """
+    Builds an analog index of the latitude-weighted z-score maps of every variable and month, stored as one float32
+    row per year with a column block for each (month, variable). Blocks can be reduced to the pixels that are
+    significantly correlated with ACE, and/or projected onto a truncated EOF basis fitted once per block
+    :param variables: the variables to be included in the index
+    :param indexDir: the directory that the index is saved to
+    :param years: the years to be included in the index, defaults to every year in the data
+    :param corrMode: None to keep every pixel, 'mask' to keep only pixels with a significant correlation to ACE, or
+    'weight' to also weight those pixels by the absolute value of their correlation
+    :param aceTarget: the ACE target whose correlation maps are used
+    :param nEofs: the number of EOFs kept for each block, or None to keep the pixels themselves
+    """
+    anomList = AnalogFinder.loadAnomalies(variables, range(1, 13))
+    if years is None:
+        years = sorted(set().union(*[set(anomData['time.year'].values.tolist()) for anomData in anomList]))
+    years = np.array(years)
+
+    # blocks are ordered by month first so that a range of months is one contiguous range of columns
+    blocks, transforms, offset = [], {}, 0
+    for month in range(1, 13):
+        for var, anomData in zip(variables, anomList):
+            num = len(blocks)
+            blockSize = int(np.prod(anomData.shape[1:]))
+            if corrMode is not None:
+                pixels, pixelWeights = getBlockTransform(var, month, corrMode, aceTarget, anomData['latitude'].values,
+                                                         anomData['longitude'].values)
+                transforms[f'pixels{num}'], transforms[f'pixelWeights{num}'] = pixels, pixelWeights
+                blockSize = len(pixels)
+            if nEofs is not None:
+                blockYears = anomData['time.year'].values[anomData['time.month'].values == month]
+                blockSize = min(nEofs, np.sum(np.isin(blockYears, years)), blockSize)
+            blocks.append(dict(variable=var, month=month, offset=offset, size=int(blockSize)))
+            offset += int(blockSize)
+
+    os.makedirs(indexDir, exist_ok=True)
+    features = np.lib.format.open_memmap(os.path.join(indexDir, 'features.npy'), mode='w+', dtype=np.float32,
+                                         shape=(len(years), offset))
+    sums, sumSqs = np.zeros((len(years), len(blocks))), np.zeros((len(years), len(blocks)))
+    present = np.zeros((len(years), len(blocks)), dtype=bool)
+    for num, block in enumerate(blocks):
+        anomData = anomList[variables.index(block['variable'])]
+        monthData = anomData.sel(time=anomData['time.month'] == block['month'])
+        yearIndex = np.searchsorted(years, monthData['time.year'].values)
+        keep = np.isin(monthData['time.year'].values, years)
+
+        # keep only the chosen pixels, weighted, and optionally project them onto the block's EOFs
+        blockData = np.nan_to_num(np.reshape(monthData.values[keep], (np.sum(keep), -1)))
+        if corrMode is not None:
+            blockData = blockData[:, transforms[f'pixels{num}']] * transforms[f'pixelWeights{num}']
+        if nEofs is not None:
+            transforms[f'eofMean{num}'], transforms[f'eofs{num}'] = fitEofs(blockData, block['size'])
+            blockData = (blockData - transforms[f'eofMean{num}']) @ transforms[f'eofs{num}'].T
+        blockData = blockData.astype(np.float32)
+
+        # store each block once, along with its sums so correlations can be calculated for any mix of blocks
+        features[yearIndex[keep], block['offset']:block['offset'] + block['size']] = blockData
+        sums[yearIndex[keep], num] = np.sum(blockData, axis=1, dtype=float)
+        sumSqs[yearIndex[keep], num] = np.sum(blockData.astype(float) ** 2, axis=1)
+        present[yearIndex[keep], num] = True
+    features.flush()
+
+    np.savez(os.path.join(indexDir, 'stats.npz'), sums=sums, sumSqs=sumSqs, present=present)
+    np.savez(os.path.join(indexDir, 'transforms.npz'), **transforms)
+    settings = dict(corrMode=corrMode, aceTarget=aceTarget, nEofs=nEofs)
+    with open(os.path.join(indexDir, 'index.json'), mode='w') as f:
+        json.dump(dict(years=years.tolist(), blocks=blocks, settings=settings), f)
+
+
+def loadIndex(indexDir):
+    """
+    Opens an analog index, with the features memory-mapped rather than read into memory
+    :param indexDir: the directory that the index was saved to
+    :return: a dictionary with the years, blocks, features, and block sums of the index
+    """
+    with open(os.path.join(indexDir, 'index.json')) as f:
+        index = json.load(f)
+    index['years'] = np.array(index['years'])
+    index['features'] = np.load(os.path.join(indexDir, 'features.npy'), mmap_mode='r')
+    with np.load(os.path.join(indexDir, 'stats.npz')) as stats:
+        index.update({name: stats[name] for name in stats.files})
+    return index
+
+
+@Instrumentation.timed('candidate scoring')
+def queryIndex(index, targetYear, months, variables=None, weights=None, possAnalogs=None, k=AnalogFinder.analogThresh):
+    """
+    Gets the top analogs for a year from an analog index. For an index of unreduced maps, scores are the same pattern
+    correlations that AnalogFinder.findAnalogs calculates, with each variable's maps scaled by the square root of its
+    weight
+    :param index: an analog index from loadIndex
+    :param targetYear: the year that analogs are calculated for
+    :param months: the months that are used for each variable
+    :param variables: the variables to be included in the analog set, defaults to every variable in the index
+    :param weights: a dictionary with the weight of each variable, defaults to equal weights
+    :param possAnalogs: the years that can be considered as analogs, defaults to every year in the index
+    :param k: the number of analogs to return
+    :return: an array of [analog year, correlation] rows sorted from best to worst, with negative correlations removed
+    """
+    blocks = index['blocks']
+    if variables is None:
+        variables = list(dict.fromkeys(block['variable'] for block in blocks))
+    if weights is None:
+        weights = {}
+    blockWeights = np.array([weights.get(block['variable'], 1.0) if block['variable'] in variables and
+                             block['month'] in months else 0.0 for block in blocks])
+    selected = np.flatnonzero(blockWeights)
+    targetRow = int(np.searchsorted(index['years'], targetYear))
+    if targetRow == len(index['years']) or index['years'][targetRow] != targetYear:
+        raise ValueError(f"{targetYear} is not in the analog index")
+    if not np.all(index['present'][targetRow, selected]):
+        raise ValueError(f"{targetYear} is missing data for some of the chosen variables and months")
+
+    # weighted dot products with the target year, one matrix-vector product per contiguous run of blocks
+    features = index['features']
+    dots = np.zeros(len(index['years']))
+    runStarts = selected[np.insert(np.diff(selected) != 1, 0, True)]
+    runEnds = selected[np.append(np.diff(selected) != 1, True)]
+    for runStart, runEnd in zip(runStarts, runEnds):
+        start = blocks[runStart]['offset']
+        end = blocks[runEnd]['offset'] + blocks[runEnd]['size']
+        columnWeights = np.repeat(blockWeights[runStart:runEnd + 1],
+                                  [block['size'] for block in blocks[runStart:runEnd + 1]]).astype(np.float32)
+        dots += features[:, start:end] @ (features[targetRow, start:end] * columnWeights)
+
+    # correlations from the dot products and each year's block sums
+    numFeatures = sum(blocks[num]['size'] for num in selected)
+    sums = index['sums'][:, selected] @ np.sqrt(blockWeights[selected])
+    sumSqs = index['sumSqs'][:, selected] @ blockWeights[selected]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (numFeatures * dots - sums * sums[targetRow]) / np.sqrt(
+            (numFeatures * sumSqs - sums ** 2) * (numFeatures * sumSqs[targetRow] - sums[targetRow] ** 2))
+
+    # only years with every chosen block, other than the target year, can be analogs
+    candidates = np.all(index['present'][:, selected], axis=1) & (index['years'] != targetYear)
+    if possAnalogs is not None:
+        candidates &= np.isin(index['years'], list(possAnalogs))
+    candidates = np.flatnonzero(candidates & np.isfinite(scores))
+
+    # partial sort for the top k, then fully sort only those
+    if k < len(candidates):
+        candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+    analogs = np.column_stack([index['years'][candidates], np.round(scores[candidates], 3)])
+    return analogs[analogs[:, 1] >= 0]
@@ -0,0 +1,142 @@
+import argparse
+import csv
+import json
+import os
+import AceCalculator
+import AceDensity
+import AnalogFinder
+import AnalogIndex
+import CorrelationCalculator
+
+# settings used by every job unless the run spec or the job overrides them
+jobDefaults = dict(variables=AnalogFinder.variables, months=list(AnalogFinder.months),
+                   possAnalogs=None, analogRange=None, k=AnalogFinder.analogThresh, weights=None)
+
+
+def loadRunSpec(path):
+    """
+    Loads a run spec from a JSON or YAML file. A run spec has a list of jobs, each with at least a target year, e.g.
+    {"jobs": [{"year": 2012}, {"year": 2005, "months": [6, 7, 8], "variables": ["sst"], "k": 5}]}, plus optional
+    "defaults" for every job and run settings ("varDir", "hurdatPath", "indexDir", "corrMode", "aceTarget", "nEofs",
+    "output", "plot", "plotDir", "correlationVariables", "rebuildIndex"). A job's candidate analog years are either
+    "possAnalogs", the exact list of years, or "analogRange", a [first, last] span of years including both ends, and
+    default to every season in the hurdat file
+    :param path: the file path for the run spec
+    :return: the run spec dictionary
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def setPaths(spec):
+    """
+    Points the modules at the input files given in a run spec, in place of their default paths. Correlation maps are
+    written to and read from the same directory, so the index uses the maps that the run calculates
+    :param spec: the run spec dictionary
+    """
+    if 'varDir' in spec:
+        AnalogFinder.varDir = CorrelationCalculator.varDir = spec['varDir']
+        AnalogFinder.cacheDir = spec['varDir'] + 'anomcache/'
+        AnalogFinder.corrDir = CorrelationCalculator.corrDir = spec['varDir'] + 'NAcorrs/'
+    if 'hurdatPath' in spec:
+        AceCalculator.hurdatPath = spec['hurdatPath']
+
+
+def getIndex(spec, variables):
+    """
+    Opens the analog index for a run, building it first if it is missing, doesn't have every variable, or was built
+    with different settings than the run spec's
+    :param spec: the run spec dictionary
+    :param variables: the variables used by any job
+    :return: the analog index
+    """
+    indexDir = spec.get('indexDir', AnalogFinder.varDir + 'analogindex/')
+    settings = dict(corrMode=spec.get('corrMode'), aceTarget=spec.get('aceTarget', 'allAce'), nEofs=spec.get('nEofs'))
+    if os.path.exists(os.path.join(indexDir, 'index.json')) and not spec.get('rebuildIndex', False):
+        index = AnalogIndex.loadIndex(indexDir)
+        if set(variables) <= set(block['variable'] for block in index['blocks']) and index['settings'] == settings:
+            return index
+    AnalogIndex.buildIndex(variables, indexDir, **settings)
+    return AnalogIndex.loadIndex(indexDir)
+
+
+def runJobs(spec):
+    """
+    Runs every job in a run spec in one process, sharing one analog index, HURDAT file, and ACE density cube
+    :param spec: the run spec dictionary
+    :return: a list with the settings and analogs of each job
+    """
+    setPaths(spec)
+    if spec.get('correlationVariables'):
+        CorrelationCalculator.runPipeline(spec['correlationVariables'])
+
+    defaults = dict(jobDefaults, **spec.get('defaults', {}))
+    jobs = [dict(defaults, **job) for job in spec['jobs']]
+    variables = list(dict.fromkeys(var for job in jobs for var in job['variables']))
+    index = getIndex(spec, variables)
+
+    # jobs without their own analog years can use every season in the hurdat file
+    densityYears = AnalogFinder.getPossAnalogs()
+    densityCube = None
+    results = []
+    for job in jobs:
+        if job['possAnalogs'] and job['analogRange']:
+            raise ValueError(f"the {job['year']} job has both possAnalogs and analogRange, use only one")
+        possAnalogs = densityYears
+        if job['possAnalogs']:
+            possAnalogs = job['possAnalogs']
+        elif job['analogRange']:
+            first, last = job['analogRange']
+            possAnalogs = range(first, last + 1)
+        analogs = AnalogIndex.queryIndex(index, job['year'], job['months'], job['variables'], job['weights'],
+                                         possAnalogs, job['k'])
+        results.append(dict(job, analogs=analogs.tolist()))
+
+        # the ACE density cube is only built if any job is plotted
+        if spec.get('plot', False) and len(analogs):
+            if densityCube is None:
+                densityCube = AceDensity.getDensityCube(AceCalculator.loadHurdat(AceCalculator.hurdatPath),
+                                                        densityYears)
+            diffHist = AceDensity.getCompositeAnomaly(densityCube, densityYears, analogs[:, 0], weights=analogs[:, 1])
+            plotDir = spec.get('plotDir', '.')
+            AnalogFinder.plotAnalogMap(diffHist, job['year'], os.path.join(plotDir, f"AceAnomMap{job['year']}.png"))
+    return results
+
+
+def saveResults(results, path):
+    """
+    Saves the analogs of every job as JSON, or as CSV with one row per analog if the path ends with .csv
+    :param results: a list with the settings and analogs of each job
+    :param path: the file path that results are saved to
+    """
+    if not path.endswith('.csv'):
+        with open(path, mode='w') as f:
+            json.dump(results, f, indent=1)
+        return
+
+    with open(path, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['year', 'months', 'variables', 'rank', 'analog', 'score'])
+        for result in results:
+            for rank, (analog, score) in enumerate(result['analogs'], start=1):
+                writer.writerow([result['year'], ' '.join(str(month) for month in result['months']),
+                                 ' '.join(result['variables']), rank, int(analog), score])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Finds analogs for every job in a run spec")
+    parser.add_argument('spec', help="JSON or YAML run spec")
+    parser.add_argument('--output', help="JSON or CSV file that results are saved to, overriding the run spec")
+    parser.add_argument('--plot', action='store_true', help="save an ACE density anomaly map for each job")
+    args = parser.parse_args()
+
+    runSpec = loadRunSpec(args.spec)
+    if args.plot:
+        runSpec['plot'] = True
+    jobResults = runJobs(runSpec)
+    for jobResult in jobResults:
+        print(f"{jobResult['year']}: {jobResult['analogs']}")
+    saveResults(jobResults, args.output or runSpec.get('output', 'analogs.json'))
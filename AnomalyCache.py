@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import numpy as np
+import xarray as xr
+import AnomalyCalculator
+import Instrumentation
+
+cacheVersion = 2  # bump when the way anomalies are calculated changes so old entries get rebuilt
+provisionalTimes = 3  # latest cached times that are read again on each update, since reanalysis revises recent months
+
+
+def hashFile(path, cacheDir):
+    """
+    Calculates a content hash of the given file, reusing the stored hash while the file's size and mtime are unchanged
+    :param path: the file path to be hashed
+    :param cacheDir: the directory that stores known file hashes
+    :return: the hex digest of the file contents
+    """
+    fileStat = os.stat(path)
+    fileId = [fileStat.st_size, fileStat.st_mtime_ns]
+    hashesPath = os.path.join(cacheDir, 'sourceHashes.json')
+    knownHashes = {}
+    if os.path.exists(hashesPath):
+        with open(hashesPath) as f:
+            knownHashes = json.load(f)
+
+    sourcePath = os.path.abspath(path)
+    if sourcePath in knownHashes and knownHashes[sourcePath][0] == fileId:
+        return knownHashes[sourcePath][1]
+
+    # hash the file in blocks so large netcdf files are never fully read into memory
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, mode='rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    knownHashes[sourcePath] = [fileId, digest.hexdigest()]
+    with open(hashesPath, mode='w') as f:
+        json.dump(knownHashes, f)
+    return digest.hexdigest()
+
+
+def getCacheKey(varName, months, removeDomainMean, weightLatitude):
+    """
+    Builds the key that identifies the settings of a cached anomaly field, which stays the same as the source file
+    grows so the entry can be updated rather than rebuilt
+    :param varName: the name of the variable in the source file
+    :param months: the months kept in the anomaly field
+    :param removeDomainMean: whether the domain-averaged z-score is removed from each map
+    :param weightLatitude: whether the anomalies are weighted by cos(latitude)
+    :return: the hex digest that identifies the cache entry
+    """
+    settings = dict(version=cacheVersion, var=varName, months=[int(mon) for mon in months],
+                    removeDomainMean=removeDomainMean, weightLatitude=weightLatitude)
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=12).hexdigest()
+
+
+def getMonthSums(maps, mapMonths, shift):
+    """
+    Adds up the maps of each calendar month relative to the month's shift map, skipping NaNs
+    :param maps: an array of maps with shape (time, lat, lon)
+    :param mapMonths: the month of each map
+    :param shift: the shift map of each month with shape (12, lat, lon)
+    :return: an array with the count, sum, and sum of squares of each pixel and month, with shape (3, 12, lat, lon)
+    """
+    sums = np.zeros((3, 12) + maps.shape[1:])
+    for month in np.unique(mapMonths):
+        monthMaps = maps[mapMonths == month] - shift[month - 1]
+        valid = ~np.isnan(monthMaps)
+        monthMaps = np.where(valid, monthMaps, 0)
+        sums[:, month - 1] = np.sum(valid, axis=0), np.sum(monthMaps, axis=0), np.sum(monthMaps ** 2, axis=0)
+    return sums
+
+
+def standardizeTimes(maps, mapMonths, climo, removeDomainMean):
+    """
+    Calculates z-score maps against the climatology of each map's month
+    :param maps: an array of maps with shape (time, lat, lon)
+    :param mapMonths: the month of each map
+    :param climo: the mean and stdev maps of each month, each with shape (12, lat, lon)
+    :param removeDomainMean: whether to subtract the domain-averaged z-score from each map
+    :return: the z-score maps, and the domain-averaged z-score that was subtracted from each map
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscores = (maps - climo[0][mapMonths - 1]) / climo[1][mapMonths - 1]
+    domainMeans = np.zeros(len(maps))
+    if removeDomainMean:
+        domainMeans = np.nanmean(zscores, axis=(1, 2))
+    return zscores - domainMeans[:, np.newaxis, np.newaxis], domainMeans
+
+
+def getClimo(sums, shift):
+    """
+    Gets the mean and stdev maps of each month from the running sums of an entry
+    :param sums: an array with the count, sum, and sum of squares of each pixel and month
+    :param shift: the shift map of each month
+    :return: an array with the mean and stdev maps of each month, with shape (2, 12, lat, lon)
+    """
+    return np.array(AnomalyCalculator.getRunningClimatology(sums[0], sums[1], sums[2], shift))
+
+
+def buildEntry(varData, removeDomainMean):
+    """
+    Calculates the unweighted anomalies of a variable from scratch
+    :param varData: the variable DataArray, with only the months kept in the anomaly field
+    :param removeDomainMean: whether to subtract the domain-averaged z-score from each map
+    :return: the anomaly array with shape (time, lat, lon), and the entry's running statistics
+    """
+    maps = Instrumentation.noteArray(varData.values)
+    mapMonths = varData['time.month'].values
+
+    # sums are kept relative to the first map of each month so they stay precise and constant pixels stay constant
+    shift = np.zeros((12,) + maps.shape[1:])
+    for month in np.unique(mapMonths):
+        shift[month - 1] = np.nan_to_num(maps[np.flatnonzero(mapMonths == month)[0]])
+    sums = getMonthSums(maps, mapMonths, shift)
+    with Instrumentation.stage('zscore'):
+        anoms, domainMeans = standardizeTimes(maps, mapMonths, getClimo(sums, shift), removeDomainMean)
+    stats = dict(times=varData['time'].values, shift=shift, sums=sums, domainMeans=domainMeans,
+                 tail=maps[max(len(maps) - provisionalTimes, 0):])
+    return anoms, stats
+
+
+def updateEntry(varData, stats, oldAnoms, removeDomainMean, weightLatitude):
+    """
+    Updates the anomalies of an older version of a source file that has since had times appended, reading only the
+    new times and the provisional times at the end of the old version from the source. The new times change each
+    month's climatology, which moves every old z-score by a per-pixel scale and offset, so old anomalies are updated
+    from the old entry rather than the source
+    :param varData: the variable DataArray, with only the months kept in the anomaly field
+    :param stats: the running statistics of the old entry
+    :param oldAnoms: the anomaly array of the old entry
+    :param removeDomainMean: whether the domain-averaged z-score is removed from each map
+    :param weightLatitude: whether the old anomalies are weighted by cos(latitude)
+    :return: the unweighted anomaly array with shape (time, lat, lon) and the entry's running statistics, or None and
+    None if the source isn't the old version with times appended
+    """
+    oldTimes, tail = stats['times'], stats['tail']
+    newTimes = varData['time'].values
+    if len(newTimes) < len(oldTimes) or not np.array_equal(newTimes[:len(oldTimes)], oldTimes):
+        return None, None
+
+    # swap the provisional times' old values for their current ones, then add the new times
+    numKept = len(oldTimes) - len(tail)
+    with Instrumentation.stage('dataset read', times=len(newTimes) - numKept):
+        maps = varData.isel(time=slice(numKept, None)).values
+    allMonths = varData['time.month'].values
+    shift = stats['shift']
+    sums = stats['sums'] - getMonthSums(tail, allMonths[numKept:len(oldTimes)], shift)
+    sums = sums + getMonthSums(maps, allMonths[numKept:], shift)
+
+    # a pixel that was constant (or a month that was missing) has no old z-score to scale, so it needs the source again
+    oldClimo, climo = getClimo(stats['sums'], shift), getClimo(sums, shift)
+    if np.any(~(oldClimo[1] > 0) & (climo[1] > 0)):
+        return None, None
+
+    with Instrumentation.stage('zscore'):
+        keptMonths = allMonths[:numKept] - 1
+        keptAnoms = oldAnoms[:numKept].astype(float)
+        if weightLatitude:
+            weights = AnomalyCalculator.weightLatitude(np.ones(varData.shape[1:]), varData.latitude.values)
+            keptAnoms = keptAnoms / weights
+        keptAnoms = keptAnoms + stats['domainMeans'][:numKept, np.newaxis, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keptAnoms = (keptAnoms * (oldClimo[1] / climo[1])[keptMonths] +
+                         ((oldClimo[0] - climo[0]) / climo[1])[keptMonths])
+        newAnoms, _ = standardizeTimes(maps, allMonths[numKept:], climo, False)
+        anoms = np.concatenate([keptAnoms, newAnoms])
+        domainMeans = np.zeros(len(anoms))
+        if removeDomainMean:
+            domainMeans = np.nanmean(anoms, axis=(1, 2))
+            anoms = anoms - domainMeans[:, np.newaxis, np.newaxis]
+    stats = dict(times=newTimes, shift=shift, sums=sums, domainMeans=domainMeans,
+                 tail=maps[max(len(maps) - provisionalTimes, 0):])
+    return anoms, stats
+
+
+def getAnomalies(sourcePath, varName, months, cacheDir, removeDomainMean=False, weightLatitude=True):
+    """
+    Gets standardized (and optionally latitude-weighted) anomalies for the given months of a variable file, building
+    and caching them only if no up-to-date cache entry exists. If the source file has had times appended since its
+    entry was built, the entry is updated from its running statistics instead of being rebuilt, so only the new times
+    are read from the source
+    :param sourcePath: the file path for the netcdf variable file
+    :param varName: the name of the variable in the source file
+    :param months: the months kept in the anomaly field
+    :param cacheDir: the directory that cache entries are stored in
+    :param removeDomainMean: whether to subtract the domain-averaged z-score from each map
+    :param weightLatitude: whether to weight the anomalies by cos(latitude)
+    :return: the anomaly DataArray, lazily backed by the cache file
+    """
+    os.makedirs(cacheDir, exist_ok=True)
+    sourceHash = hashFile(sourcePath, cacheDir)
+    entryPrefix = os.path.splitext(os.path.basename(sourcePath))[0] + '_' + varName + '_'
+    settingsPrefix = entryPrefix + getCacheKey(varName, months, removeDomainMean, weightLatitude) + '_'
+    entryPath = os.path.join(cacheDir, settingsPrefix + sourceHash[:16] + '.nc')
+    if os.path.exists(entryPath):
+        return xr.open_dataarray(entryPath)
+
+    anoms = None
+    with Instrumentation.stage('dataset open', path=sourcePath), xr.open_dataset(sourcePath) as varDataset:
+        varData = varDataset[varName].transpose('time', 'latitude', 'longitude')
+        varData = varData.sel(time=varData['time.month'].isin(list(months)))
+
+        # update the entry of an older version of the source file if there is one
+        for fileName in os.listdir(cacheDir):
+            oldPath = os.path.join(cacheDir, fileName)
+            if fileName.startswith(settingsPrefix) and fileName.endswith('.nc') and \
+                    os.path.exists(oldPath[:-3] + '.stats.npz'):
+                with np.load(oldPath[:-3] + '.stats.npz') as oldStats, xr.open_dataarray(oldPath) as oldData:
+                    if np.array_equal(oldData.latitude, varData.latitude) and \
+                            np.array_equal(oldData.longitude, varData.longitude):
+                        anoms, stats = updateEntry(varData, dict(oldStats), oldData.values, removeDomainMean,
+                                                   weightLatitude)
+                break
+        if anoms is None:
+            with Instrumentation.stage('dataset read', path=sourcePath):
+                varData = varData.load()
+            anoms, stats = buildEntry(varData, removeDomainMean)
+        if weightLatitude:
+            with Instrumentation.stage('latitude weighting'):
+                anoms = AnomalyCalculator.weightLatitude(anoms, varData.latitude.values)
+        anomData = xr.DataArray(anoms.astype(varData.dtype), coords=varData.coords, dims=varData.dims, name=varName)
+
+    # replace the entry built from an older version of the source file, then write the new entry with one chunk per
+    # map. Entries with other settings are left for their own update the next time they are asked for
+    for fileName in os.listdir(cacheDir):
+        if fileName.startswith(settingsPrefix) and '_' + sourceHash[:16] + '.' not in fileName:
+            os.remove(os.path.join(cacheDir, fileName))
+    encoding = {varName: dict(zlib=True, complevel=1, chunksizes=(1,) + anomData.shape[1:])}
+    tempPath = entryPath + '.tmp'
+    anomData.to_netcdf(tempPath, encoding=encoding)
+    np.savez(entryPath[:-3] + '.stats.npz', **stats)
+    os.replace(tempPath, entryPath)
+    return xr.open_dataarray(entryPath)
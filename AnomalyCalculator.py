@@ -0,0 +1,110 @@
+import numpy as np
+import Instrumentation
+
+
+@Instrumentation.timed('dataset read')
+def monthCube(data, years, month):
+    """
+    Gets the variable data for the given month of every year in one selection
+    :param data: the variable DataArray to be used
+    :param years: the years that data is retrieved for
+    :param month: the month that data is retrieved for
+    :return: an array of maps with shape (year, lat, lon)
+    """
+    dates = np.array([np.datetime64(f"{year}-{month:02d}", 'D') for year in years])
+    return data.sel(time=dates).values
+
+
+@Instrumentation.timed('zscore')
+def standardizeCube(cube, removeDomainMean=True):
+    """
+    Calculates z-score maps for every year of a single month, using one mean/stdev map for the whole cube
+    :param cube: an array of maps with shape (year, lat, lon)
+    :param removeDomainMean: whether to subtract the domain-averaged z-score from each year's map
+    :return: an array of z-score maps with the same shape as cube
+    """
+    allMeans = np.mean(cube, axis=0)
+    allStds = np.std(cube, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        allZScores = (cube - allMeans) / allStds
+    if removeDomainMean:
+        spatialAxes = tuple(range(1, cube.ndim))
+        allZScores = allZScores - np.nanmean(allZScores, axis=spatialAxes, keepdims=True)
+    return Instrumentation.noteArray(allZScores)
+
+
+def getRunningClimatology(count, total, totalSq, shift):
+    """
+    Gets mean and stdev maps from running sums of maps that were each shifted by a fixed map before being added up,
+    which keeps the sums precise for large values and makes the stdev of a constant pixel exactly zero
+    :param count: the number of maps added up, in total or for each pixel
+    :param total: the sum of the shifted maps
+    :param totalSq: the sum of squares of the shifted maps
+    :param shift: the map that was subtracted from every map
+    :return: the mean map and the stdev map
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meanShifted = total / count
+        variance = np.maximum(totalSq / count - meanShifted ** 2, 0)
+    return meanShifted + shift, np.sqrt(variance)
+
+
+def weightLatitude(maps, latitude):
+    """
+    Weights maps by cos(latitude), so each pixel counts in proportion to the area it covers
+    :param maps: an array of maps with shape (..., lat, lon)
+    :param latitude: the latitudes of the maps
+    :return: the weighted maps
+    """
+    return maps * np.cos(np.radians(latitude))[:, np.newaxis]
+
+
+@Instrumentation.timed('zscore')
+def standardizeMaps(maps, allMeans, allStds, latitude):
+    """
+    Calculates latitude-weighted z-score maps from precomputed mean/stdev maps, matching the anomalies AnomalyCache
+    builds from a whole variable file
+    :param maps: an array of maps with shape (..., lat, lon)
+    :param allMeans: the mean map of each map's month, broadcastable against maps
+    :param allStds: the stdev map of each map's month, broadcastable against maps
+    :param latitude: the latitudes of the maps
+    :return: an array of weighted z-score maps with the same shape as maps, with NaNs set to zero
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscores = (maps - allMeans) / allStds
+    return np.nan_to_num(weightLatitude(zscores, latitude))
+
+
+def monthAnomalies(data, years, month, removeDomainMean=True):
+    """
+    Calculates z-score maps for the given month of every year in the given period
+    :param data: the variable DataArray to be used
+    :param years: the years that the mean/stdev are based off and that maps are calculated for
+    :param month: the month that maps are calculated for
+    :param removeDomainMean: whether to subtract the domain-averaged z-score from each year's map
+    :return: an array of z-score maps with shape (year, lat, lon)
+    """
+    return standardizeCube(monthCube(data, years, month), removeDomainMean)
+
+
+@Instrumentation.timed('zscore')
+def zscoreMonths(data, removeDomainMean=False):
+    """
+    Normalizes variable data to account for different amounts of variability in different regions, using a separate
+    mean/stdev map for each calendar month
+    :param data: the variable DataArray to be normalized
+    :param removeDomainMean: whether to subtract the domain-averaged z-score from each map
+    :return: the normalized variable DataArray, in the same time order as data
+    """
+    monthGroups = data.groupby('time.month')
+    allMeans = monthGroups.mean(dim='time')
+    allStds = monthGroups.std(dim='time')
+
+    # broadcast the appropriate mean/std maps against every time in a single pass
+    zscoreData = (monthGroups - allMeans).groupby('time.month') / allStds
+    zscoreData = zscoreData.drop_vars('month')
+    if removeDomainMean:
+        spatialDims = [dim for dim in zscoreData.dims if dim != 'time']
+        zscoreData = zscoreData - zscoreData.mean(dim=spatialDims)
+    return zscoreData
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time as t
+import tracemalloc
+import numpy as np
+import xarray as xr
+import AceCalculator
+import AceDensity
+import AnalogFinder
+import AnomalyCalculator
+import CorrelationCalculator
+import CorrelationSignificance
+
+
+def createSyntheticVariable(path, years, numLats, numLons, seed=0):
+    """
+    Creates an ERA5-like monthly netcdf file of random fields, with a seasonal cycle and a patch of land (NaNs)
+    :param path: the file path that the netcdf file is saved to
+    :param years: the years of data
+    :param numLats: the number of latitudes
+    :param numLons: the number of longitudes
+    :param seed: the random seed
+    :return: the variable DataArray
+    """
+    rng = np.random.default_rng(seed)
+    time = np.array([np.datetime64(f"{year}-{month:02d}-01", 'ns') for year in years for month in range(1, 13)])
+    latitude = np.linspace(90, -90, numLats)
+    longitude = np.linspace(0, 360, numLons, endpoint=False)
+    seasonal = 10 * np.cos(np.radians(latitude))[:, np.newaxis] * np.ones(numLons)
+    values = rng.normal(size=(len(time), numLats, numLons)).astype(np.float32) + seasonal
+    values[:, :numLats // 4, :numLons // 4] = np.nan
+    data = xr.DataArray(values, dims=('time', 'latitude', 'longitude'), name='sst',
+                        coords=dict(time=time, latitude=latitude, longitude=longitude))
+    data.to_dataset().to_netcdf(path)
+    return data
+
+
+def createSyntheticHurdat(path, years, stormsPerYear=15, seed=0):
+    """
+    Creates a HURDAT2-like text file of random Atlantic storms
+    :param path: the file path that the hurdat file is saved to
+    :param years: the years of storms
+    :param stormsPerYear: the average number of storms in each year
+    :param seed: the random seed
+    """
+    rng = np.random.default_rng(seed)
+    lines = []
+    for year in years:
+        for stormNum in range(1, rng.poisson(stormsPerYear) + 2):
+            numFixes = int(rng.integers(8, 60))
+            lines.append(f"AL{stormNum:02d}{year},            UNNAMED,     {numFixes},")
+            date = np.datetime64(f"{year}-06-01") + np.timedelta64(int(rng.integers(0, 150)), 'D')
+            lat, lon, wind = rng.uniform(10, 25), rng.uniform(20, 95), 25
+            for fixNum in range(numFixes):
+                fixTime = date + np.timedelta64(6 * fixNum, 'h')
+                fixDate, fixHour = str(fixTime)[:10].replace('-', ''), str(fixTime)[11:13] + '00'
+                wind = int(np.clip(wind + rng.normal(3, 10), 20, 160))
+                status = 'TD' if wind < 34 else 'TS' if wind < 64 else 'HU'
+                lines.append(f"{fixDate}, {fixHour},  , {status}, {lat:4.1f}N, {lon:5.1f}W, {wind:3d}, {1010 - wind}, "
+                             + ", ".join(['-999'] * 13) + ",")
+                lat, lon = lat + rng.normal(0.4, 0.5), lon + rng.normal(0.6, 0.8)
+    with open(path, mode='w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def runStage(stage, numItems, repeats):
+    """
+    Times a benchmark stage and measures its peak traced memory
+    :param stage: a function that runs the stage once
+    :param numItems: the number of items the stage processes, for throughput
+    :param repeats: the number of timed runs, of which the fastest is kept
+    :return: a dictionary of results
+    """
+    tracemalloc.start()
+    stage()
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeats):
+        start = t.perf_counter()
+        stage()
+        times.append(t.perf_counter() - start)
+    return dict(seconds=min(times), throughput=numItems / min(times), peakBytes=peakBytes)
+
+
+def getCommit():
+    """
+    Gets the current git commit of the repository, if there is one
+    :return: the commit hash, or None
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(numLats, numLons, numYears, repeats=3, workDir=None):
+    """
+    Runs every benchmark stage on synthetic data of the given size
+    :param numLats: the number of latitudes
+    :param numLons: the number of longitudes
+    :param numYears: the number of years of data
+    :param repeats: the number of timed runs of each stage
+    :param workDir: the directory that synthetic files are written to, defaults to a temporary directory
+    :return: a list of result dictionaries, one per stage
+    """
+    with tempfile.TemporaryDirectory() as tempDir:
+        workDir = workDir or tempDir
+        years = list(range(2023 - numYears + 1, 2024))
+        varData = createSyntheticVariable(os.path.join(workDir, 'sstEraModified.nc'), years, numLats, numLons)
+        hurdatPath = os.path.join(workDir, 'hurdat.txt')
+        createSyntheticHurdat(hurdatPath, years)
+
+        track = AceCalculator.parseHurdat(hurdatPath)
+        aceTable = AceCalculator.getAceTable(track, years)
+        aceTargets = np.array([AceCalculator.sumMonthAce(aceTable, aceMonth)
+                               for aceMonth in CorrelationCalculator.aceMonths]).T
+        anomCube = AnomalyCalculator.monthAnomalies(varData, years, 8)
+        anomData = AnomalyCalculator.zscoreMonths(varData)
+        features = np.nan_to_num(np.reshape(anomData.values, (numYears, -1)))
+        numPixels = numLats * numLons
+
+        # each stage with the number of items it processes
+        stages = dict(
+            parse=(lambda: AceCalculator.parseHurdat(hurdatPath), len(track), 'fixes'),
+            aceAggregation=(lambda: AceCalculator.getAceTable(track, years), len(track), 'fixes'),
+            zscore=(lambda: AnomalyCalculator.monthAnomalies(varData, years, 8), numYears * numPixels, 'values'),
+            zscoreAllMonths=(lambda: AnomalyCalculator.zscoreMonths(varData), varData.size, 'values'),
+            correlationMaps=(lambda: CorrelationCalculator.maskCorrelation(anomCube, aceTargets),
+                             numPixels * aceTargets.shape[1], 'maps pixels'),
+            analogScoring=(lambda: AnalogFinder.correlationMatrix(features), features.size, 'values'),
+            significance=(lambda: CorrelationSignificance.testSignificance(anomCube, aceTargets[:, 0], 100),
+                          numPixels * 100, 'pixel resamples'),
+            densityHistograms=(lambda: AceDensity.getDensityCube(track, years), len(track), 'fixes'),
+        )
+
+        results = []
+        grid = dict(numLats=numLats, numLons=numLons, numYears=numYears)
+        for stageName, (stage, numItems, unit) in stages.items():
+            result = dict(stage=stageName, commit=getCommit(), grid=grid, unit=unit, numItems=numItems)
+            result.update(runStage(stage, numItems, repeats))
+            print(f"{stageName}: {result['seconds']:.4f} s, {result['throughput']:.3g} {unit}/s, "
+                  f"{result['peakBytes'] / 2 ** 20:.1f} MiB peak")
+            results.append(result)
+        varData.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times each stage of the analog pipeline on synthetic data")
+    parser.add_argument('--lats', type=int, default=181, help="number of latitudes")
+    parser.add_argument('--lons', type=int, default=360, help="number of longitudes")
+    parser.add_argument('--years', type=int, default=54, help="number of years of data")
+    parser.add_argument('--repeats', type=int, default=3, help="number of timed runs of each stage")
+    parser.add_argument('--output', default='benchResults.jsonl', help="file that results are appended to (JSON lines)")
+    args = parser.parse_args()
+
+    benchResults = runBenchmarks(args.lats, args.lons, args.years, args.repeats)
+    with open(args.output, mode='a') as f:
+        for benchResult in benchResults:
+            f.write(json.dumps(benchResult) + "\n")
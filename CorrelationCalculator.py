@@ -1,68 +1,118 @@
 import xarray as xr
 import numpy as np
-from scipy.stats import pearsonr
+from scipy.special import betainc
 import AceCalculator
+import AnomalyCalculator
+import CorrelationSignificance
+import CorrelationStore
+import Instrumentation
 from multiprocessing import Pool
+import os
 import time as t
 
-variable = "sst"
+variables = ["sst"]  # variables that correlation maps are calculated for
 aceMonths = [range(1, 13), [1], [2], [3], [4], [5], [6], [7], [8], [9], [10], [11], [12]]
-corrYears = list(range(1970, 2023))
+corrYears = None  # years that correlations are based off, None for every hurdat season that the variable files cover
+significanceTest = None  # None for the analytic p <= 0.05 test, or 'fdr', 'maxT' or 'field' for a resampling test
+resampleMethod = 'permutation'  # how ACE series are resampled for significance tests, 'permutation' or 'bootstrap'
+numResamples = 1000  # number of resampled ACE series for significance tests
 
-# variable path and dictionaries for conversions
-varPath = 'C:/Users/Ketan Trivedi/Desktop/Nikhil/variablefiles/' + variable + 'EraLowRes.nc'
+# variable/correlation paths and dictionaries for conversions
+varDir = 'C:/Users/Ketan Trivedi/Desktop/Nikhil/variablefiles/'
+corrDir = varDir + 'NAcorrs/'
+corrPrecision = 'float32'  # on-disk encoding of the correlation maps, 'float32' or 'int16'
 varDict = {"sst": "sst", "slp": "msl", "hgt": "z", "vp": "velocity_potential", "stream": "streamfunction", "shum": "q",
            "cape": "cape", "uwnd200": "u"}
 monthsDict = {1: "January", 2: "February", 3: "March", 4: "April", 5: "May", 6: "June", 7: "July", 8: "August",
               9: "September", 10: "October", 11: "November", 12: "December", range(1, 13): "all"}
 
 
-def createDataset(path):
+@Instrumentation.timed('dataset open')
+def createDataset(variable):
     """
     Creates a xarray DataArray for the given variable
-    :param path: the file path for the netcdf variable file
+    :param variable: the variable to be opened
     :return: the xarray DataArray for the variable
     """
-    dataset = xr.open_dataset(path)
+    dataset = xr.open_dataset(varDir + variable + 'EraLowRes.nc')
     data = dataset[varDict[variable]]
     return data
 
 
-def climoSet(data, period, month):
+@Instrumentation.timed('correlation')
+def correlateCube(anomCube, aceVals, pixelChunk=10000):
     """
-    gets the variable data for the given month in the given period
-    :param data: the variable data to be used
-    :param period: the period of time that data is retrieved for
-    :param month: the month that data is retrieved for
-    :return: a list with each element being a year of data in the period
+    Correlates every pixel of an anomaly cube with one or more ACE series, one matrix multiply per chunk of pixels so
+    only a chunk of a memory-mapped cube is ever copied into memory. Results match scipy.stats.pearsonr applied pixel
+    by pixel, with NaN pixels (e.g. land) treated as zeros
+    :param anomCube: array of anomaly maps with shape (year, lat, lon)
+    :param aceVals: array of ACE values with shape (year,) or (year, target)
+    :param pixelChunk: the number of pixels correlated at once, which bounds memory use
+    :return: correlation and two-sided p-value maps, each with shape (target, lat, lon)
     """
-    month = format(month, '02d')
-    years = []
-    for year in period:
-        date = np.datetime64(str(year) + '-' + str(month), 'D')
-        years.append(data.sel(time=date))
-    return years
+    aceVals = np.asarray(aceVals, dtype=float)
+    if aceVals.ndim == 1:
+        aceVals = aceVals[:, np.newaxis]
+    numYears = anomCube.shape[0]
+    aceData = aceVals - np.mean(aceVals, axis=0)
+    aceNorms = np.sqrt(np.sum(aceData ** 2, axis=0))
 
+    # center each chunk's pixel series, then correlate them with every ACE series at once
+    cubePixels = np.reshape(anomCube, (numYears, -1))
+    corrs = np.empty((cubePixels.shape[1], aceVals.shape[1]))
+    for start in range(0, cubePixels.shape[1], pixelChunk):
+        pixelData = np.nan_to_num(cubePixels[:, start:start + pixelChunk])
+        pixelData = pixelData - np.mean(pixelData, axis=0)
+        normProduct = np.outer(np.sqrt(np.sum(pixelData ** 2, axis=0)), aceNorms)
 
-def zscoreThing(data, years, month, calcYear):
+        # constant pixels (e.g. land) have no defined correlation, same as pearsonr
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunkCorrs = np.clip((pixelData.T @ aceData) / normProduct, -1, 1)
+        chunkCorrs[normProduct == 0] = np.nan
+        corrs[start:start + pixelChunk] = chunkCorrs
+
+    # same beta distribution p-value that pearsonr uses
+    pValues = betainc(numYears / 2 - 1, 0.5, 1 - corrs ** 2)
+
+    mapShape = (aceVals.shape[1],) + anomCube.shape[1:]
+    return np.reshape(corrs.T, mapShape), np.reshape(pValues.T, mapShape)
+
+
+def maskCorrelation(anomCube, aceVals):
     """
-    Calculates a z-score map for the given month and year
-    :param data: the variable data to be used
-    :param years: the list of years that z-scores mean/stdev are based off
-    :param month: the month that data is calculated for
-    :param calcYear: the year that data is calculated for
-    :return: a z-score map for the given month and year
+    Calculates correlation maps between an anomaly cube and one or more ACE series, keeping only the correlations that
+    are significant
+    :param anomCube: array of anomaly maps with shape (year, lat, lon)
+    :param aceVals: array of ACE values with shape (year,) or (year, target)
+    :return: the significant correlation maps with shape (target, lat, lon), with all other pixels set to zero
     """
-    allMeans = np.mean(np.array(years), axis=0)
-    allStds = np.std(np.array(years), axis=0)
+    corrs, pValues = correlateCube(anomCube, aceVals)
+    if significanceTest is None:
+        corrs = np.where(pValues <= 0.05, corrs, 0)
+        return np.nan_to_num(corrs)
 
-    month = format(month, '02d')
-    date = np.datetime64(str(calcYear) + '-' + str(month), 'D')
-    calcYearData = data.sel(time=date)
+    # test each ACE target against resampled copies of its series, accounting for every pixel being tested
+    aceVals = np.reshape(aceVals, (len(aceVals), -1))
+    masks = [CorrelationSignificance.testSignificance(anomCube, aceVals[:, target], numResamples, resampleMethod,
+                                                      confidence=False)[significanceTest + 'Mask']
+             for target in range(aceVals.shape[1])]
+    return np.nan_to_num(np.where(masks, corrs, 0))
 
-    allZScores = (calcYearData - allMeans) / allStds
-    allZScores = allZScores - np.mean(allZScores)
-    return allZScores
+
+def getCorrYears(varDatasets):
+    """
+    Gets the years that correlations are based off, which default to every season in the hurdat file that every
+    variable file has all 12 months of, so new data is picked up without editing corrYears
+    :param varDatasets: the variable DataArrays that correlations are calculated for
+    :return: a list of years
+    """
+    if corrYears is not None:
+        return list(corrYears)
+    years = set(AceCalculator.getSeasonYears(AceCalculator.loadHurdat(AceCalculator.hurdatPath)).tolist())
+    for varDataset in varDatasets:
+        dataYears, numMonths = np.unique(varDataset['time.year'].values, return_counts=True)
+        years &= set(dataYears[numMonths == 12].tolist())
+    return sorted(years)
 
 
 def getCorrelation(varDataset, aceVals, varMonth):
@@ -71,73 +121,178 @@ def getCorrelation(varDataset, aceVals, varMonth):
     variable is SST data, the aceVals are for September only, and the month is June, a correlation map between June
     SST's and September ACE will be calculated
     :param varDataset: xarray dataset for a variable
-    :param aceVals: List of ACE values for a given month and time period
+    :param aceVals: List of ACE values for the years given by getCorrYears, or an array with one column per ACE target
     :param varMonth: month that the correlation map is calculated for
-    :return: a global correlation map
+    :return: a global correlation map, or one map per ACE target if aceVals has multiple columns
+    """
+    anomCube = AnomalyCalculator.monthAnomalies(varDataset, getCorrYears([varDataset]), varMonth)
+    corrs = maskCorrelation(anomCube, aceVals)
+
+    if np.ndim(aceVals) == 1:
+        return corrs[0]
+    return corrs
+
+
+@Instrumentation.timed('ace aggregation')
+def getAceTargets(years):
+    """
+    Gets the ACE series for every entry in aceMonths
+    :param years: the years that ACE is calculated for
+    :return: an array of ACE values with shape (year, target)
+    """
+    aceTable = AceCalculator.getAceTable(AceCalculator.loadHurdat(AceCalculator.hurdatPath), years)
+    return np.array([AceCalculator.sumMonthAce(aceTable, aceMonth) for aceMonth in aceMonths]).T
+
+
+def getPartPath(variable, varMonth):
+    """
+    Gets the file path that the correlation maps of one variable month are saved to until the variable is finished
+    :param variable: the variable that the maps are calculated for
+    :param varMonth: the month of variable data that the maps are calculated for
+    :return: the file path for the saved maps
+    """
+    return corrDir + variable + 'EraCorr.parts/' + format(varMonth, '02d') + '.npy'
+
+
+def saveCorrDataset(variable, correlations):
+    """
+    Saves the correlation maps of a variable to the correlation store
+    :param variable: the variable that the maps were calculated for
+    :param correlations: an array of correlation maps with shape (ACE target, variable month, lat, lon)
+    """
+    latLonValues = createDataset(variable)
+    CorrelationStore.writeCorrelations(corrDir + CorrelationStore.storeName, variable, correlations,
+                                       latLonValues.latitude.values, latLonValues.longitude.values, corrPrecision)
+
+
+def getAnomPath(variable):
+    """
+    Gets the file path that a variable's anomaly cube is shared with the pool workers through
+    :param variable: the variable that the anomalies are calculated for
+    :return: the file path for the memory-mapped anomaly cube
+    """
+    return os.path.dirname(getPartPath(variable, 1)) + '/anoms.npy'
+
+
+def publishAnomalies(variable, varMonths, years):
+    """
+    Calculates a variable's anomaly cube once and writes it to a memory-mapped file that every worker can read without
+    making its own copy
+    :param variable: the variable that the anomalies are calculated for
+    :param varMonths: the months of variable data that anomalies are calculated for
+    :param years: the years that anomalies are calculated for
     """
-    # each element in switchedData is a list data from each year for a given pixel
-    allYears = climoSet(varDataset, corrYears, varMonth)
-    allFlattenedData = np.array([zscoreThing(varDataset, allYears, varMonth, year).values.flatten() for year in
-                                 corrYears])
-    switchedData = np.nan_to_num(allFlattenedData.T)
+    varDataset = createDataset(variable)
+    anomPath = getAnomPath(variable)
+    anomShape = (12, len(years)) + varDataset.shape[1:]
+    anoms = np.lib.format.open_memmap(anomPath + '.tmp.npy', mode='w+', dtype=float, shape=anomShape)
+    for varMonth in varMonths:
+        anoms[varMonth - 1] = AnomalyCalculator.monthAnomalies(varDataset, years, varMonth)
+    anoms.flush()
+    del anoms
+    os.replace(anomPath + '.tmp.npy', anomPath)
+
+
+def initWorker(aceData):
+    """
+    Stores the read-only data shared by every work unit in each pool worker
+    :param aceData: an array of ACE values with shape (year, ACE target)
+    """
+    global workerAce, workerAnoms
+    workerAce = aceData
+    workerAnoms = {}
+
 
-    # each element is a correlation for a given pixel
-    corrList = np.array([pearsonr(pixelData, aceVals) for pixelData in switchedData])
-    corrList = np.where(corrList[:, 1] <= 0.05, corrList[:, 0], 0)
+def main(unit):
+    variable, varMonth = unit
+    print("Generating correlation maps for " + variable + " variable month " + str(varMonth))
 
-    # list of correlations is reshaped to map of correlations
-    corrList = np.reshape(corrList, varDataset.shape[1:])
-    corrList = np.nan_to_num(corrList)
+    # attach to the variable's published anomaly cube, keeping the others since variables overlap
+    anomPath = getAnomPath(variable)
+    if anomPath not in workerAnoms:
+        workerAnoms[anomPath] = np.load(anomPath, mmap_mode='r')
 
-    return corrList
+    # correlate variable data to ACE for every ACE target at once
+    return unit, maskCorrelation(workerAnoms[anomPath][varMonth - 1], workerAce)
 
 
-def main(aceMonth):
-    print("Generating correlation map for month " + str(aceMonth))
+def getUnits(pending, years):
+    """
+    Yields the work units of every variable, publishing each variable's anomaly cube just before its units. The pool
+    draws units from this as workers need them, so the next variable is published while the last one's units run
+    :param pending: a dictionary with the unfinished variable months of each variable
+    :param years: the years that correlations are based off
+    :return: a generator of (variable, variable month) work units
+    """
+    for variable, varMonths in pending.items():
+        if not varMonths:
+            continue
+        publishAnomalies(variable, varMonths, years)
+        for varMonth in varMonths:
+            yield variable, varMonth
 
-    # get 1970-present ACE for given month
-    yearsAce = np.array(AceCalculator.getMonthAce(aceMonth))
-    aceData = yearsAce[:, 1]
 
-    # create dataset for given variable
-    varDataset = createDataset(varPath)
+def combineParts(variable):
+    """
+    Saves the correlation maps of a variable whose months are all finished and removes the saved months
+    :param variable: the variable that the maps were calculated for
+    """
+    partPaths = [getPartPath(variable, varMonth) for varMonth in range(1, 13)]
+    correlations = np.swapaxes(np.array([np.load(path) for path in partPaths]), 0, 1)
+    saveCorrDataset(variable, correlations)
+    for path in partPaths:
+        os.remove(path)
 
-    # correlate variable data to ACE for each month of variable data
-    corrMonths = np.array([getCorrelation(varDataset, aceData, varMonth) for varMonth in range(1, 13)])
-    return corrMonths
+
+def runPipeline(variables, processes=None):
+    """
+    Calculates and saves the correlation maps of every variable, with (variable, variable month) work units spread
+    across a process pool. Each variable's anomalies are calculated once and shared with the workers through a
+    memory-mapped file, so memory stays roughly flat as workers are added, and the units of every variable share one
+    queue so variables overlap. Each finished unit is saved right away, so a rerun after a crash skips finished units
+    and variables already in the correlation store
+    :param variables: the variables that correlation maps are calculated for
+    :param processes: the number of worker processes, defaults to the number of cores
+    """
+    pending = {}
+    storeVariables = CorrelationStore.getStoreVariables(corrDir + CorrelationStore.storeName)
+    for variable in variables:
+        if variable in storeVariables:
+            continue
+        os.makedirs(os.path.dirname(getPartPath(variable, 1)), exist_ok=True)
+        pending[variable] = [month for month in range(1, 13) if not os.path.exists(getPartPath(variable, month))]
+
+    # variables whose months were all saved before a crash only need to be combined
+    for variable in pending:
+        if not pending[variable]:
+            combineParts(variable)
+
+    # every ACE target is calculated once here and handed to the workers instead of being recalculated by each one.
+    # Units of every variable go to the pool together, so workers never wait for a variable to be published or saved
+    remaining = {variable: len(varMonths) for variable, varMonths in pending.items() if varMonths}
+    years = getCorrYears([createDataset(variable) for variable in remaining])
+    try:
+        with Pool(processes, initializer=initWorker, initargs=(getAceTargets(years),)) as pool:
+            for unit, corrMaps in pool.imap_unordered(main, getUnits(pending, years)):
+                partPath = getPartPath(*unit)
+                np.save(partPath + '.tmp.npy', corrMaps)
+                os.replace(partPath + '.tmp.npy', partPath)
+
+                # save the variable's correlation maps once all of its months are finished
+                remaining[unit[0]] -= 1
+                if remaining[unit[0]] == 0:
+                    combineParts(unit[0])
+    finally:
+        # the anomaly files can only be removed once no worker has them mapped. Saved months are kept for a rerun
+        for variable in pending:
+            if os.path.exists(getAnomPath(variable)):
+                os.remove(getAnomPath(variable))
+            if not os.listdir(os.path.dirname(getAnomPath(variable))):
+                os.rmdir(os.path.dirname(getAnomPath(variable)))
 
 
 if __name__ == '__main__':
-    # calculate all correlations in parallel and store them in correlations
+    # calculate all correlations in parallel and save them as each variable finishes
     start = t.time()
-    with Pool() as pool:
-        correlations = pool.map(main, aceMonths)
+    runPipeline(variables)
     print("Finished in " + str(round(t.time() - start)) + " seconds")
-
-    # create and save correlation dataset
-    latLonValues = createDataset(varPath)
-    time = np.arange('1969-01-01', '1970-01-01', dtype='datetime64[M]')
-    ds = xr.Dataset(
-        data_vars=dict(
-            allAce=(["time", "latitude", "longitude"], correlations[0]),
-            janAce=(["time", "latitude", "longitude"], correlations[1]),
-            febAce=(["time", "latitude", "longitude"], correlations[2]),
-            marAce=(["time", "latitude", "longitude"], correlations[3]),
-            aprAce=(["time", "latitude", "longitude"], correlations[4]),
-            mayAce=(["time", "latitude", "longitude"], correlations[5]),
-            junAce=(["time", "latitude", "longitude"], correlations[6]),
-            julAce=(["time", "latitude", "longitude"], correlations[7]),
-            augAce=(["time", "latitude", "longitude"], correlations[8]),
-            sepAce=(["time", "latitude", "longitude"], correlations[9]),
-            octAce=(["time", "latitude", "longitude"], correlations[10]),
-            novAce=(["time", "latitude", "longitude"], correlations[11]),
-            decAce=(["time", "latitude", "longitude"], correlations[12]),
-        ),
-        coords=dict(
-            time=(["time"], time),
-            latitude=(["latitude"], latLonValues.latitude.values),
-            longitude=(["longitude"], latLonValues.longitude.values)
-        )
-    )
-    print(ds)
-    ds.to_netcdf('C:/Users/Ketan Trivedi/Desktop/Nikhil/variablefiles/NAcorrs/' + variable + 'EraCorr.nc')
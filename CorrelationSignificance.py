@@ -0,0 +1,180 @@
+from multiprocessing import Pool
+import numpy as np
+from scipy.special import stdtrit
+import Instrumentation
+
+
+def getResampleIndex(numYears, numResamples, method='permutation', blockLength=3, seed=0):
+    """
+    Draws the years of every resample of a series. Block bootstraps draw circular blocks of consecutive years, so the
+    autocorrelation of the series is kept within each block
+    :param numYears: the number of years in the series
+    :param numResamples: the number of resamples
+    :param method: 'permutation' to shuffle the years, or 'bootstrap' for a circular block bootstrap
+    :param blockLength: the number of consecutive years in each bootstrap block
+    :param seed: the random seed
+    :return: an array of year indices with shape (resample, year)
+    """
+    rng = np.random.default_rng(seed)
+    if method == 'permutation':
+        return rng.permuted(np.tile(np.arange(numYears), (numResamples, 1)), axis=1)
+    if method == 'bootstrap':
+        numBlocks = -(-numYears // blockLength)
+        blockStarts = rng.integers(0, numYears, size=(numResamples, numBlocks, 1))
+        return ((blockStarts + np.arange(blockLength)) % numYears).reshape(numResamples, -1)[:, :numYears]
+    raise ValueError(f"unknown resampling method {method}")
+
+
+def getCriticalCorrelation(numYears, alpha):
+    """
+    Gets the smallest correlation magnitude that is locally significant with the analytic two-sided test
+    :param numYears: the number of years correlated
+    :param alpha: the significance level
+    :return: the critical correlation
+    """
+    tValue = stdtrit(numYears - 2, 1 - alpha / 2)
+    return tValue / np.sqrt(numYears - 2 + tValue ** 2)
+
+
+def initWorker(nullAce, bootCounts, aceVals, criticalCorr, ciLevel):
+    """
+    Stores the resampled ACE series shared by every pixel chunk in each pool worker
+    :param nullAce: an array of centered, unit-norm resampled ACE series with shape (year, resample)
+    :param bootCounts: an array of how many times each year is drawn in each bootstrap with shape (resample, year), or
+    None to skip confidence intervals
+    :param aceVals: the ACE series with shape (year,)
+    :param criticalCorr: the smallest locally significant correlation magnitude
+    :param ciLevel: the confidence level of the intervals
+    """
+    global workerNull, workerCounts, workerAce, workerCritical, workerLevel
+    workerNull, workerCounts, workerAce = nullAce, bootCounts, aceVals
+    workerCritical, workerLevel = criticalCorr, ciLevel
+
+
+def resampleChunk(pixelData):
+    """
+    Correlates a chunk of pixels with every resampled ACE series in one matrix multiply, and reduces the results to
+    what the whole field needs, so memory only ever scales with the chunk size
+    :param pixelData: an array of pixel series with shape (year, pixel)
+    :return: the correlation of each pixel, the number of null correlations at least as strong as each pixel's, the
+    strongest null correlation and number of locally significant pixels of each resample, and the lower and upper
+    confidence bounds of each pixel
+    """
+    pixelData = np.nan_to_num(pixelData)
+    pixelData = pixelData - np.mean(pixelData, axis=0)
+    pixelNorms = np.sqrt(np.sum(pixelData ** 2, axis=0))
+    aceData = workerAce - np.mean(workerAce)
+
+    # constant pixels (e.g. land) have no defined correlation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corrs = (pixelData.T @ aceData) / (pixelNorms * np.linalg.norm(aceData))
+        nullCorrs = np.abs((pixelData.T @ workerNull) / pixelNorms[:, np.newaxis])
+    validPixels = pixelNorms > 0
+    corrs[~validPixels] = np.nan
+    nullCorrs = nullCorrs[validPixels]
+
+    # small tolerance so resamples that reproduce the observed correlation count as exceedances
+    exceedCounts = np.zeros(len(corrs), dtype=int)
+    exceedCounts[validPixels] = np.sum(nullCorrs >= np.abs(corrs[validPixels])[:, np.newaxis] - 1e-12, axis=1)
+    maxNull = np.max(nullCorrs, axis=0, initial=0)
+    localCounts = np.sum(nullCorrs >= workerCritical, axis=0)
+    if workerCounts is None:
+        return corrs, exceedCounts, maxNull, localCounts, None, None
+
+    # bootstrap correlations from weighted sums, where each year is weighted by how many times it was drawn
+    numYears = len(aceData)
+    sumX, sumXX = workerCounts @ pixelData, workerCounts @ pixelData ** 2
+    sumXY = workerCounts @ (pixelData * aceData[:, np.newaxis])
+    sumY, sumYY = workerCounts @ aceData, workerCounts @ aceData ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bootCorrs = ((numYears * sumXY - sumX * sumY[:, np.newaxis]) /
+                     np.sqrt((numYears * sumXX - sumX ** 2) * (numYears * sumYY - sumY ** 2)[:, np.newaxis]))
+    tails = [(1 - workerLevel) / 2, (1 + workerLevel) / 2]
+    ciLower, ciUpper = np.quantile(bootCorrs, tails, axis=0)
+    return corrs, exceedCounts, maxNull, localCounts, ciLower, ciUpper
+
+
+def getFdrMask(pValues, alpha):
+    """
+    Finds the pixels that are significant with the Benjamini-Hochberg procedure, which keeps the expected fraction of
+    false discoveries at or below alpha
+    :param pValues: an array of p-values, with NaN for pixels that aren't tested
+    :param alpha: the false discovery rate
+    :return: a boolean array of significant pixels with the same shape as pValues
+    """
+    testedValues = np.sort(pValues[~np.isnan(pValues)])
+    passed = testedValues <= alpha * np.arange(1, len(testedValues) + 1) / len(testedValues)
+    if not np.any(passed):
+        return np.zeros(pValues.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        return pValues <= testedValues[np.flatnonzero(passed)[-1]]
+
+
+@Instrumentation.timed('significance')
+def testSignificance(anomCube, aceVals, numResamples=1000, method='permutation', blockLength=3, alpha=0.05,
+                     confidence=True, ciLevel=0.95, pixelChunk=10000, processes=1, seed=0):
+    """
+    Tests the correlation of every pixel of an anomaly cube with an ACE series against resampled ACE series, which
+    are correlated with the whole cube as batched matrix products over chunks of pixels. Gives masks that account for
+    testing every pixel at once: a false discovery rate mask, a max-T mask that bounds the chance of any false
+    positive, and a field significance test of the number of locally significant pixels
+    :param anomCube: array of anomaly maps with shape (year, lat, lon)
+    :param aceVals: array of ACE values with shape (year,)
+    :param numResamples: the number of resampled ACE series (and of bootstraps for the confidence intervals)
+    :param method: 'permutation' to shuffle the ACE series, or 'bootstrap' for a circular block bootstrap that keeps
+    its autocorrelation
+    :param blockLength: the number of consecutive years in each bootstrap block
+    :param alpha: the significance level
+    :param confidence: whether to calculate block bootstrap confidence intervals of each correlation
+    :param ciLevel: the confidence level of the intervals
+    :param pixelChunk: the number of pixels correlated at once, which bounds memory use
+    :param processes: the number of processes that chunks are spread across
+    :param seed: the random seed
+    :return: a dictionary of maps with shape (lat, lon): 'corr', 'pValue' (from the resamples), 'fdrMask', 'maxTMask',
+    'fieldMask' (the analytic local mask if the field is significant, else nothing), 'ciLower' and 'ciUpper', plus
+    the scalar 'fieldPValue'
+    """
+    aceVals = np.asarray(aceVals, dtype=float)
+    numYears = anomCube.shape[0]
+    mapShape = anomCube.shape[1:]
+    pixelData = np.reshape(anomCube, (numYears, -1))
+
+    # center and normalize each resampled ACE series once, so each chunk only needs one matrix multiply
+    nullAce = aceVals[getResampleIndex(numYears, numResamples, method, blockLength, seed)].T
+    nullAce = nullAce - np.mean(nullAce, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nullAce = nullAce / np.linalg.norm(nullAce, axis=0)
+    bootCounts = None
+    if confidence:
+        bootIndex = getResampleIndex(numYears, numResamples, 'bootstrap', blockLength, seed + 1)
+        bootCounts = np.zeros((numResamples, numYears))
+        np.add.at(bootCounts, (np.arange(numResamples)[:, np.newaxis], bootIndex), 1)
+
+    criticalCorr = getCriticalCorrelation(numYears, alpha)
+    initArgs = (nullAce, bootCounts, aceVals, criticalCorr, ciLevel)
+    chunks = (pixelData[:, start:start + pixelChunk] for start in range(0, pixelData.shape[1], pixelChunk))
+    if processes == 1:
+        initWorker(*initArgs)
+        chunkResults = list(map(resampleChunk, chunks))
+    else:
+        with Pool(processes, initializer=initWorker, initargs=initArgs) as pool:
+            chunkResults = pool.map(resampleChunk, chunks)
+    corrs, exceedCounts, maxNull, localCounts, ciLower, ciUpper = zip(*chunkResults)
+    corrs = np.concatenate(corrs)
+    maxNull = np.max(maxNull, axis=0)
+    localCounts = np.sum(localCounts, axis=0)
+    pValues = np.where(np.isnan(corrs), np.nan, (np.concatenate(exceedCounts) + 1) / (numResamples + 1))
+
+    # the field is significant if few resamples have as many locally significant pixels as observed
+    with np.errstate(invalid='ignore'):
+        localMask = np.abs(corrs) >= criticalCorr
+        maxTMask = np.abs(corrs) > np.quantile(maxNull, 1 - alpha)
+    fieldPValue = (np.sum(localCounts >= np.sum(localMask)) + 1) / (numResamples + 1)
+
+    maps = dict(corr=corrs, pValue=pValues, fdrMask=getFdrMask(pValues, alpha), maxTMask=maxTMask,
+                fieldMask=localMask & (fieldPValue <= alpha))
+    if confidence:
+        maps['ciLower'], maps['ciUpper'] = np.concatenate(ciLower), np.concatenate(ciUpper)
+    maps = {name: np.reshape(values, mapShape) for name, values in maps.items()}
+    maps['fieldPValue'] = fieldPValue
+    return maps
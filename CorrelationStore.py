@@ -0,0 +1,173 @@
+import argparse
+import glob
+import os
+import numpy as np
+import xarray as xr
+
+# names of the ACE targets, in the order CorrelationCalculator.aceMonths calculates them
+aceTargets = ["allAce", "janAce", "febAce", "marAce", "aprAce", "mayAce", "junAce", "julAce", "augAce", "sepAce",
+              "octAce", "novAce", "decAce"]
+storeName = 'corrStore.nc'  # file name of the correlation store in a correlation directory
+incrementalStoreName = 'corrStoreIncremental.nc'  # file name of the store of IncrementalUpdater's correlation maps
+
+# on-disk encodings of the correlation maps. int16 packs correlations (always between -1 and 1) at about 3e-5
+# resolution, half the size of float32, since netcdf has no float16
+encodings = dict(
+    float32=dict(dtype='float32'),
+    int16=dict(dtype='int16', scale_factor=1 / 32000, _FillValue=np.int16(-32768)),
+)
+
+# open stores, keyed by file path, with the modification time they were opened at
+openStores = {}
+
+
+def openStore(storePath):
+    """
+    Opens a correlation store lazily, reusing the open store until the file changes. Nothing is read until a map is
+    selected, and then only the chunks of the selected maps are decoded
+    :param storePath: the file path of the correlation store
+    :return: the correlation DataArray with dims (variable, ace_target, var_month, latitude, longitude)
+    """
+    fileTime = os.stat(storePath).st_mtime_ns
+    if storePath in openStores:
+        if openStores[storePath][0] != fileTime:
+            closeStore(storePath)
+    if storePath not in openStores:
+        openStores[storePath] = fileTime, xr.open_dataset(storePath)
+    return openStores[storePath][1]['correlation']
+
+
+def closeStore(storePath):
+    """
+    Closes a correlation store if it is open, so the file can be replaced
+    :param storePath: the file path of the correlation store
+    """
+    if storePath in openStores:
+        openStores.pop(storePath)[1].close()
+
+
+def getStoreVariables(storePath):
+    """
+    Gets the variables that a correlation store has maps for
+    :param storePath: the file path of the correlation store
+    :return: a list of variables, empty if the store doesn't exist yet
+    """
+    if not os.path.exists(storePath):
+        return []
+    return openStore(storePath)['variable'].values.tolist()
+
+
+def getVariableMaps(storePath, variable):
+    """
+    Gets every correlation map of a variable from a correlation store
+    :param storePath: the file path of the correlation store
+    :param variable: the variable that the maps were calculated for
+    :return: the correlation DataArray with dims (ace_target, var_month, latitude, longitude)
+    """
+    storeVariables = getStoreVariables(storePath)
+    if variable not in storeVariables:
+        raise ValueError(f"correlation store {storePath} has no maps for {variable}, only for {storeVariables}")
+    return openStore(storePath).sel(variable=variable)
+
+
+def getStoreGrid(storePath):
+    """
+    Gets the grid that the maps of a correlation store were calculated on
+    :param storePath: the file path of the correlation store
+    :return: the latitudes and longitudes of the maps
+    """
+    storeData = openStore(storePath)
+    return storeData['latitude'].values, storeData['longitude'].values
+
+
+def readCorrMap(storePath, variable, varMonth, aceTarget='allAce'):
+    """
+    Reads a single correlation map from a correlation store
+    :param storePath: the file path of the correlation store
+    :param variable: the variable that the map was calculated for
+    :param varMonth: the month of variable data that the map was calculated for
+    :param aceTarget: the ACE target that the map was calculated for
+    :return: the correlation map, with insignificant correlations set to zero
+    """
+    return getVariableMaps(storePath, variable).sel(ace_target=aceTarget, var_month=varMonth).values
+
+
+def readCorrMonths(storePath, variable, firstMonth=1, lastMonth=12, aceTarget='allAce'):
+    """
+    Reads the correlation maps of a range of months from a correlation store
+    :param storePath: the file path of the correlation store
+    :param variable: the variable that the maps were calculated for
+    :param firstMonth: the first month of variable data to be read
+    :param lastMonth: the last month of variable data to be read
+    :param aceTarget: the ACE target that the maps were calculated for
+    :return: the correlation DataArray with dims (var_month, latitude, longitude)
+    """
+    corrData = getVariableMaps(storePath, variable).sel(ace_target=aceTarget, var_month=slice(firstMonth, lastMonth))
+    return corrData.load()
+
+
+def writeCorrelations(storePath, variable, correlations, latitude, longitude, precision='float32'):
+    """
+    Adds a variable's correlation maps to a correlation store, creating the store or replacing the variable's maps if
+    needed. Maps are stored compressed in one chunk each, so reading a map never decodes any other
+    :param storePath: the file path of the correlation store
+    :param variable: the variable that the maps were calculated for
+    :param correlations: an array of correlation maps with shape (ACE target, variable month, lat, lon)
+    :param latitude: the latitudes of the maps
+    :param longitude: the longitudes of the maps
+    :param precision: 'float32', or 'int16' to pack the maps into half the space
+    """
+    corrData = xr.DataArray(
+        np.asarray(correlations, dtype=np.float32)[np.newaxis], name='correlation',
+        dims=["variable", "ace_target", "var_month", "latitude", "longitude"],
+        coords=dict(variable=[variable], ace_target=aceTargets, var_month=np.arange(1, 13), latitude=latitude,
+                    longitude=longitude)
+    )
+
+    # the store is small next to the variable files, so adding a variable rewrites it. Names are read back as
+    # fixed-width strings as wide as the longest stored name, so they are cast to objects before adding a longer one
+    if set(getStoreVariables(storePath)) - {variable}:
+        storeData = openStore(storePath)
+        otherData = storeData.sel(variable=storeData['variable'] != variable).load()
+        otherData = otherData.assign_coords(variable=otherData['variable'].values.astype(object))
+        otherData['variable'].encoding = {}
+        corrData = xr.concat([otherData, corrData], dim='variable', join='exact')
+
+    # the open store has to be closed before it can be replaced, which Windows enforces
+    closeStore(storePath)
+    names = corrData['variable'].values.tolist()
+    if len(set(names)) != len(names):
+        raise ValueError(f"correlation store {storePath} has duplicate variables {names}")
+    corrData = corrData.assign_coords(variable=np.array(names, dtype=object))
+
+    encoding = dict(encodings[precision], zlib=True, complevel=4, chunksizes=(1, 1, 1) + corrData.shape[3:])
+    corrData.to_dataset().to_netcdf(storePath + '.tmp', encoding=dict(correlation=encoding, variable=dict(dtype=str)))
+    os.replace(storePath + '.tmp', storePath)
+
+
+def convertCorrFile(corrPath, storePath, variable, precision='float32'):
+    """
+    Adds the maps of an old correlation file, with one data variable per ACE target over a 1969 time axis, to a
+    correlation store
+    :param corrPath: the file path of the old correlation file
+    :param storePath: the file path of the correlation store
+    :param variable: the variable that the maps were calculated for
+    :param precision: 'float32', or 'int16' to pack the maps into half the space
+    """
+    with xr.open_dataset(corrPath) as corrDataset:
+        corrDataset = corrDataset.sortby('time')
+        correlations = np.array([corrDataset[aceTarget].values for aceTarget in aceTargets])
+        writeCorrelations(storePath, variable, correlations, corrDataset.latitude.values,
+                          corrDataset.longitude.values, precision)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts every EraCorr.nc file in a directory to a correlation store")
+    parser.add_argument('corrDir', help="directory of the correlation files, where the store is saved")
+    parser.add_argument('--precision', choices=list(encodings), default='float32', help="on-disk encoding of the maps")
+    args = parser.parse_args()
+
+    for corrFile in sorted(glob.glob(os.path.join(args.corrDir, '*EraCorr.nc'))):
+        corrVariable = os.path.basename(corrFile)[:-len('EraCorr.nc')]
+        print("Converting " + corrVariable)
+        convertCorrFile(corrFile, os.path.join(args.corrDir, storeName), corrVariable, args.precision)
@@ -0,0 +1,274 @@
+import os
+import numpy as np
+import xarray as xr
+from scipy.special import betainc
+import AceCalculator
+import AnalogFinder
+import AnalogIndex
+import AnomalyCalculator
+import CorrelationCalculator
+import CorrelationStore
+
+stateDir = 'incremental/'  # directory in AnalogFinder.varDir that the running statistics of each variable are kept in
+
+
+def createState(varData, years, aceTable, aceYears):
+    """
+    Creates the running statistics of a variable from every month of the given years. The statistics hold sums, sums of
+    squares, and cross-products with each ACE target for every pixel and month, so climatologies and correlation maps
+    can later be updated with new data alone
+    :param varData: the variable DataArray
+    :param years: the years of variable data to start from
+    :param aceTable: an array of ACE values with shape (year, ACE target)
+    :param aceYears: the years of the rows in aceTable
+    :return: a dictionary of running statistics
+    """
+    mapShape = varData.shape[1:]
+    numTargets = aceTable.shape[1]
+    state = dict(mapShape=np.array(mapShape), shift=np.zeros((12,) + mapShape), ingested=np.zeros((0, 2), dtype=int),
+                 aceYears=np.array(aceYears, dtype=int), aceTable=np.array(aceTable, dtype=float),
+                 climoCount=np.zeros(12), climoSum=np.zeros((12,) + mapShape), climoSumSq=np.zeros((12,) + mapShape),
+                 corrCount=np.zeros(12), corrSum=np.zeros((12,) + mapShape), corrSumSq=np.zeros((12,) + mapShape),
+                 corrCross=np.zeros((12, numTargets) + mapShape), aceSum=np.zeros((12, numTargets)),
+                 aceSumSq=np.zeros((12, numTargets)))
+
+    # sums are kept relative to the first map of each month so they don't lose precision for large values
+    dataMonths = varData['time.month'].values
+    dataYears = varData['time.year'].values
+    for month in range(1, 13):
+        monthYears = [year for year in years if np.any((dataYears == year) & (dataMonths == month))]
+        if monthYears:
+            state['shift'][month - 1] = varData.sel(time=np.datetime64(f"{monthYears[0]}-{month:02d}", 'D')).values
+            for year in monthYears:
+                addMonth(state, varData, year, month)
+    return state
+
+
+def addMonth(state, varData, year, month):
+    """
+    Adds one month of variable data to the running statistics
+    :param state: a dictionary of running statistics
+    :param varData: the variable DataArray, which must contain the given year and month
+    :param year: the year of the new data
+    :param month: the month of the new data
+    """
+    if np.any(np.all(state['ingested'] == [year, month], axis=1)):
+        return
+    monthMap = varData.sel(time=np.datetime64(f"{year}-{month:02d}", 'D')).values - state['shift'][month - 1]
+    state['climoCount'][month - 1] += 1
+    state['climoSum'][month - 1] += monthMap
+    state['climoSumSq'][month - 1] += monthMap ** 2
+    state['ingested'] = np.vstack([state['ingested'], [year, month]])
+
+    # only years with ACE can add to the correlations
+    if year in state['aceYears']:
+        addCorrMap(state, monthMap, state['aceTable'][list(state['aceYears']).index(year)], month)
+
+
+def addCorrMap(state, monthMap, yearAce, month):
+    """
+    Adds a shifted map and its year's ACE values to the correlation statistics
+    :param state: a dictionary of running statistics
+    :param monthMap: the map minus the month's shift map
+    :param yearAce: the ACE value of each ACE target for the map's year
+    :param month: the month of the map
+    """
+    state['corrCount'][month - 1] += 1
+    state['corrSum'][month - 1] += monthMap
+    state['corrSumSq'][month - 1] += monthMap ** 2
+    state['corrCross'][month - 1] += yearAce[:, np.newaxis, np.newaxis] * monthMap
+    state['aceSum'][month - 1] += yearAce
+    state['aceSumSq'][month - 1] += yearAce ** 2
+
+
+def addAceSeason(state, varData, year, yearAce):
+    """
+    Adds a new season of ACE to the running statistics, pairing it with every month of variable data already added for
+    that year
+    :param state: a dictionary of running statistics
+    :param varData: the variable DataArray
+    :param year: the year of the new season
+    :param yearAce: the ACE value of each ACE target for the new season
+    """
+    if year in state['aceYears']:
+        return
+    state['aceYears'] = np.append(state['aceYears'], year)
+    state['aceTable'] = np.vstack([state['aceTable'], yearAce])
+    for month in state['ingested'][state['ingested'][:, 0] == year, 1]:
+        monthMap = varData.sel(time=np.datetime64(f"{year}-{month:02d}", 'D')).values - state['shift'][month - 1]
+        addCorrMap(state, monthMap, np.asarray(yearAce, dtype=float), month)
+
+
+def getClimatology(state, month):
+    """
+    Gets the mean and stdev maps of a month from the running statistics
+    :param state: a dictionary of running statistics
+    :param month: the month of the maps
+    :return: the mean map and the stdev map
+    """
+    return AnomalyCalculator.getRunningClimatology(state['climoCount'][month - 1], state['climoSum'][month - 1],
+                                                   state['climoSumSq'][month - 1], state['shift'][month - 1])
+
+
+def getCorrMaps(state):
+    """
+    Calculates the significant correlation maps between every month of variable data and every ACE target from the
+    running statistics. Z-scoring each pixel does not change its correlation, but unlike CorrelationCalculator the
+    domain-averaged z-score is not removed from each year's map, since that couples every pixel together and cannot
+    be kept as per-pixel sums. The maps are a separate product, so they are saved to their own store by saveCorrMaps
+    :param state: a dictionary of running statistics
+    :return: an array of correlation maps with shape (ACE target, variable month, lat, lon)
+    """
+    count = state['corrCount'][:, np.newaxis, np.newaxis, np.newaxis]
+    covariance = count * state['corrCross'] - state['aceSum'][:, :, np.newaxis, np.newaxis] * \
+        state['corrSum'][:, np.newaxis]
+    varVariance = count * state['corrSumSq'][:, np.newaxis] - state['corrSum'][:, np.newaxis] ** 2
+    aceVariance = count * state['aceSumSq'][:, :, np.newaxis, np.newaxis] - \
+        state['aceSum'][:, :, np.newaxis, np.newaxis] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corrs = np.clip(covariance / np.sqrt(varVariance * aceVariance), -1, 1)
+
+    # same significance test as CorrelationCalculator.correlateCube
+    pValues = betainc(count / 2 - 1, 0.5, 1 - corrs ** 2)
+    corrs = np.nan_to_num(np.where(pValues <= 0.05, corrs, 0))
+    return np.swapaxes(corrs, 0, 1)
+
+
+def saveCorrMaps(state, variable, latitude, longitude):
+    """
+    Saves the correlation maps of the running statistics to the incremental correlation store, which is kept apart
+    from CorrelationCalculator's store since its maps keep each year's domain mean
+    :param state: a dictionary of running statistics
+    :param variable: the variable that the statistics are for
+    :param latitude: the latitudes of the variable data
+    :param longitude: the longitudes of the variable data
+    """
+    os.makedirs(CorrelationCalculator.corrDir, exist_ok=True)
+    CorrelationStore.writeCorrelations(CorrelationCalculator.corrDir + CorrelationStore.incrementalStoreName, variable,
+                                       getCorrMaps(state), latitude, longitude, CorrelationCalculator.corrPrecision)
+
+
+def updateIndexMonth(indexDir, state, varData, variable, year, month):
+    """
+    Writes the z-score map of one new month into an existing analog index, using the climatology in the running
+    statistics. The new map changes the month's climatology, so the block's other years are standardized again too,
+    keeping every row of the block on the same climatology. Only that one (variable, month) block is rewritten, and
+    its pixel mask and EOFs are kept as they were built. The year must already have a row in the index, e.g. by
+    building it with years that extend into the future
+    :param indexDir: the directory that the index was saved to
+    :param state: a dictionary of running statistics for the index's variable file
+    :param varData: the variable DataArray
+    :param variable: the index variable that the data belongs to
+    :param year: the year of the new data
+    :param month: the month of the new data
+    """
+    index = AnalogIndex.loadIndex(indexDir)
+    num = [block['variable'] == variable and block['month'] == month for block in index['blocks']].index(True)
+    block = index['blocks'][num]
+    if year not in index['years']:
+        raise ValueError(f"{year} has no row in the analog index, rebuild it with more years")
+
+    # standardize and weight every year of the month the same way the index was built
+    allMeans, allStds = getClimatology(state, month)
+    monthData = varData.sel(time=varData['time.month'] == month)
+    monthData = monthData.sel(time=monthData['time.year'].isin(index['years']))
+    rows = np.searchsorted(index['years'], monthData['time.year'].values)
+    blockData = AnomalyCalculator.standardizeMaps(monthData.values, allMeans, allStds, monthData.latitude.values)
+    blockData = np.reshape(blockData, (len(rows), -1))
+    with np.load(os.path.join(indexDir, 'transforms.npz')) as transforms:
+        if f'pixels{num}' in transforms:
+            blockData = blockData[:, transforms[f'pixels{num}']] * transforms[f'pixelWeights{num}']
+        if f'eofs{num}' in transforms:
+            blockData = (blockData - transforms[f'eofMean{num}']) @ transforms[f'eofs{num}'].T
+    blockData = blockData.astype(np.float32)
+
+    # only the block and its sums are written
+    features = np.load(os.path.join(indexDir, 'features.npy'), mmap_mode='r+')
+    features[rows, block['offset']:block['offset'] + block['size']] = blockData
+    features.flush()
+    index['sums'][rows, num] = np.sum(blockData, axis=1, dtype=float)
+    index['sumSqs'][rows, num] = np.sum(blockData.astype(float) ** 2, axis=1)
+    index['present'][rows, num] = True
+    np.savez(os.path.join(indexDir, 'stats.npz'), sums=index['sums'], sumSqs=index['sumSqs'],
+             present=index['present'])
+
+
+def getSeasonAce(year, aceMonths=CorrelationCalculator.aceMonths):
+    """
+    Gets the ACE of every ACE target for a single season from the HURDAT file
+    :param year: the year of the season
+    :param aceMonths: the months of each ACE target
+    :return: an array with the ACE value of each ACE target
+    """
+    aceTable = AceCalculator.getAceTable(AceCalculator.loadHurdat(AceCalculator.hurdatPath), [year])
+    return np.array([AceCalculator.sumMonthAce(aceTable, aceMonth)[0] for aceMonth in aceMonths])
+
+
+def saveState(state, statePath):
+    """
+    Saves running statistics to a file
+    :param state: a dictionary of running statistics
+    :param statePath: the file path that the statistics are saved to
+    """
+    np.savez(statePath + '.tmp.npz', **state)
+    os.replace(statePath + '.tmp.npz', statePath)
+
+
+def loadState(statePath):
+    """
+    Loads running statistics from a file
+    :param statePath: the file path that the statistics were saved to
+    :return: a dictionary of running statistics
+    """
+    with np.load(statePath) as state:
+        return {name: state[name] for name in state.files}
+
+
+def updateVariable(variable, indexDir=None):
+    """
+    Runs one update cycle for a variable file after a new month of data or a new HURDAT season arrives. Every month of
+    the file that the running statistics don't have yet is added, every new season is paired with the months of its
+    year, and the correlation maps and the index blocks of the new months are updated. The climatologies cover every
+    year of the file, the same as AnomalyCache's, while only seasons from AceCalculator.firstSeason add to the
+    correlations. The first cycle creates the running statistics from the whole file, assuming the index was already
+    built from it
+    :param variable: the variable to be updated, with its file in AnalogFinder.varDir
+    :param indexDir: the directory of the analog index to be updated, or None to leave it alone
+    :return: a list of the (year, month) pairs that were added
+    """
+    statePath = AnalogFinder.varDir + stateDir + variable + 'State.npz'
+    seasons = AceCalculator.getSeasonYears(AceCalculator.loadHurdat(AceCalculator.hurdatPath)).tolist()
+    with xr.open_dataset(AnalogFinder.varDir + variable + 'EraModified.nc') as varDataset:
+        varData = varDataset[AnalogFinder.varDict[variable]]
+        dataYears = np.unique(varData['time.year'].values).tolist()
+        if not os.path.exists(statePath):
+            os.makedirs(os.path.dirname(statePath), exist_ok=True)
+            state = createState(varData, dataYears, CorrelationCalculator.getAceTargets(seasons), seasons)
+            added = []
+        else:
+            state = loadState(statePath)
+            ingested = set(map(tuple, state['ingested'].tolist()))
+            added = [(year, month) for year, month in zip(varData['time.year'].values.tolist(),
+                                                          varData['time.month'].values.tolist())
+                     if (year, month) not in ingested]
+            for year, month in added:
+                addMonth(state, varData, year, month)
+            for year in seasons:
+                if year not in state['aceYears']:
+                    addAceSeason(state, varData, year, getSeasonAce(year))
+
+        saveCorrMaps(state, variable, varData.latitude.values, varData.longitude.values)
+        if indexDir is not None:
+            # each block is standardized again once, against the climatology with all of its new months
+            for month in sorted(set(month for _, month in added)):
+                newYear = max(year for year, addedMonth in added if addedMonth == month)
+                updateIndexMonth(indexDir, state, varData, variable, newYear, month)
+    saveState(state, statePath)
+    return added
+
+
+if __name__ == '__main__':
+    # add whatever is new in each variable file and HURDAT to the correlation maps and analog index
+    for var in AnalogFinder.variables:
+        newMonths = updateVariable(var, AnalogFinder.varDir + 'analogindex/')
+        print(f"Added {len(newMonths)} months of {var}: {newMonths}")
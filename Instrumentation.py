@@ -0,0 +1,109 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time as t
+
+# set ANALOG_TRACE to a file path to record a Chrome trace (chrome://tracing, Perfetto) of every pipeline stage
+tracePath = os.environ.get('ANALOG_TRACE')
+enabled = bool(tracePath)
+
+traceLock = threading.Lock()
+stageStack = threading.local()
+
+
+def readBytes():
+    """
+    Gets the number of bytes this process has read so far, where the OS reports it
+    :return: the number of bytes read, or None
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def writeEvent(event):
+    """
+    Appends an event to the trace file. The closing bracket of the JSON array is optional in the Chrome trace format,
+    so every process can append to the same file as it goes
+    :param event: the Chrome trace event
+    """
+    with traceLock, open(tracePath, mode='a') as f:
+        if f.tell() == 0:
+            f.write('[\n')
+        f.write(json.dumps(event) + ',\n')
+
+
+@contextlib.contextmanager
+def traceStage(name, **args):
+    """
+    Records the wall time, CPU time, bytes read, and noted allocation sizes of a block of code
+    :param name: the name of the stage
+    :param args: extra values to record with the stage
+    """
+    info = dict(args, allocatedBytes=0)
+    if not hasattr(stageStack, 'stages'):
+        stageStack.stages = []
+    stageStack.stages.append(info)
+    startBytes = readBytes()
+    startCpu = t.process_time()
+    start = t.perf_counter()
+    try:
+        yield info
+    finally:
+        wallTime = t.perf_counter() - start
+        info['cpuSeconds'] = t.process_time() - startCpu
+        endBytes = readBytes()
+        if startBytes is not None and endBytes is not None:
+            info['bytesRead'] = endBytes - startBytes
+        stageStack.stages.pop()
+        writeEvent(dict(name=name, ph='X', ts=(t.time() - wallTime) * 1e6, dur=wallTime * 1e6, pid=os.getpid(),
+                        tid=threading.get_ident(), args=info))
+
+
+def stage(name, **args):
+    """
+    Gets a context manager that records a block of code as a pipeline stage when tracing is enabled and does nothing
+    otherwise
+    :param name: the name of the stage
+    :param args: extra values to record with the stage
+    :return: the context manager, which yields a dictionary that extra values can be added to
+    """
+    if not enabled:
+        return contextlib.nullcontext({})
+    return traceStage(name, **args)
+
+
+def timed(name):
+    """
+    Decorates a function so every call is recorded as a pipeline stage when tracing is enabled. When tracing is
+    disabled the function is returned unchanged, so it costs nothing
+    :param name: the name of the stage
+    :return: the decorator
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with traceStage(name, function=func.__qualname__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def noteArray(array):
+    """
+    Adds the size of an array to the allocation total of the innermost stage being recorded
+    :param array: the newly allocated array
+    :return: the same array
+    """
+    if enabled and getattr(stageStack, 'stages', None):
+        stageStack.stages[-1]['allocatedBytes'] += int(getattr(array, 'nbytes', 0))
+    return array
@@ -0,0 +1,160 @@
+import multiprocessing as mp
+import os
+import numpy as np
+import AceDensity
+
+# dictionary for conversions
+monthsDict = {1: "January", 2: "February", 3: "March", 4: "April", 5: "May", 6: "June", 7: "July", 8: "August",
+              9: "September", 10: "October", 11: "November", 12: "December"}
+
+corrLevels = np.arange(-1, 1, 0.02)  # contour levels of the correlation maps
+aceExtent = [-100, -5, 5, 50]  # longitude and latitude extent of the ACE density anomaly maps
+
+# the base map and colorbar of each kind of figure, built once per process and reused for every figure
+baseMaps = {}
+colorbars = {}
+
+
+def getBaseMap(kind):
+    """
+    Gets the figure and map axes of a kind of figure, building them the first time. The map features and
+    gridlines are drawn from the same axes for every figure, so Natural Earth geometries are only loaded and projected
+    once per process. Figures are rendered with the Agg backend, so nothing is displayed
+    :param kind: 'corr' for correlation maps or 'ace' for ACE density anomaly maps
+    :return: the figure and map axes
+    """
+    if kind in baseMaps:
+        return baseMaps[kind]
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import cartopy.crs as ccrs
+    import cartopy.feature as cf
+    import matplotlib.pyplot as plt
+
+    # plot cartopy map and various features
+    if kind == 'corr':
+        fig = plt.figure()
+        ax = fig.add_subplot(projection=ccrs.PlateCarree(central_longitude=180))
+        ax.coastlines(linewidth=0.5, resolution='50m')
+        ax.add_feature(cf.BORDERS, linewidth=0.3)
+        ax.add_feature(cf.STATES, linewidth=0.2, edgecolor="gray")
+        ax.add_feature(cf.LAND)
+        ax.set_global()
+    else:
+        fig = plt.figure(figsize=(12, 6))
+        ax = fig.add_subplot(projection=ccrs.PlateCarree())
+        ax.add_feature(cf.LAND)
+        ax.add_feature(cf.STATES, linewidth=0.2, edgecolor="gray")
+        ax.add_feature(cf.BORDERS, linewidth=0.3)
+        ax.coastlines(linewidth=0.5, resolution='50m')
+
+        # plot gridlines
+        gl = ax.gridlines(crs=ccrs.PlateCarree(central_longitude=0), draw_labels=True, linewidth=1, color='gray',
+                          alpha=0.5, linestyle='--')
+        gl.top_labels = gl.right_labels = False
+        gl.xlabel_style = {'size': 7, 'weight': 'bold', 'color': 'gray'}
+        gl.ylabel_style = {'size': 7, 'weight': 'bold', 'color': 'gray'}
+        ax.set_extent(aceExtent)
+
+    baseMaps[kind] = fig, ax
+    return baseMaps[kind]
+
+
+def updateColorbar(kind, fig, ax, artist):
+    """
+    Points the colorbar of a kind of figure at a newly drawn artist, adding the colorbar the first time
+    :param kind: 'corr' for correlation maps or 'ace' for ACE density anomaly maps
+    :param fig: the figure of the base map
+    :param ax: the map axes of the base map
+    :param artist: the contour set or image that was drawn
+    :return: the colorbar
+    """
+    if kind in colorbars:
+        colorbars[kind].update_normal(artist)
+    elif kind == 'corr':
+        colorbars[kind] = fig.colorbar(artist, ax=ax, orientation='horizontal', pad=0.04, aspect=50)
+    else:
+        colorbars[kind] = fig.colorbar(artist, ax=ax, pad=0.015, aspect=27, shrink=0.99, extend='both')
+    colorbars[kind].ax.tick_params(labelsize=7)
+    return colorbars[kind]
+
+
+def renderFigure(figure):
+    """
+    Draws a figure's data on top of its base map, saves it, and removes the data again so the base map can be reused
+    :param figure: a dictionary with the kind of figure ('corr' or 'ace'), its data, title, and save path, as made by
+    getCorrFigures or getAceFigure
+    :return: the file path that the figure was saved to
+    """
+    import cartopy.crs as ccrs
+
+    fig, ax = getBaseMap(figure['kind'])
+    if figure['kind'] == 'corr':
+        artist = ax.contourf(figure['lons'], figure['lats'], figure['data'], corrLevels, extend='both', cmap='RdBu_r',
+                             transform=ccrs.PlateCarree())
+        updateColorbar('corr', fig, ax, artist).set_ticks([-1, -0.5, 0, 0.5, 1])
+        fontSize = 7
+    else:
+        artist = ax.imshow(figure['data'].T, interpolation='gaussian', cmap='RdBu_r', origin='lower',
+                           extent=AceDensity.densityRange[0] + AceDensity.densityRange[1], vmin=-figure['vmax'],
+                           vmax=figure['vmax'], transform=ccrs.PlateCarree())
+        ax.set_extent(aceExtent)
+        updateColorbar('ace', fig, ax, artist)
+        fontSize = 9
+
+    # add title, then save and clear the data from the base map
+    ax.set_title(figure['title'], fontsize=fontSize, weight='bold', loc='left')
+    ax.set_title("DCAreaWx", fontsize=fontSize, weight='bold', loc='right', color='gray')
+    fig.savefig(figure['savePath'], dpi=300, bbox_inches='tight')
+    artist.remove()
+    return figure['savePath']
+
+
+def getCorrFigures(corrData, variable, saveDir):
+    """
+    Creates a figure for every month of a variable's correlation maps
+    :param corrData: the correlation DataArray with dims (var_month, latitude, longitude)
+    :param variable: the variable that the maps are for
+    :param saveDir: the directory that figures are saved to
+    :return: a list of figure dictionaries for renderFigure
+    """
+    figures = []
+    for corrMap in corrData:
+        month = int(corrMap.var_month)
+        figures.append(dict(kind='corr', data=corrMap.values, lons=corrData.longitude.values,
+                            lats=corrData.latitude.values,
+                            title=f"ERA5 {monthsDict[month]} {variable.upper()}'s Correlated to Atlantic ACE",
+                            savePath=os.path.join(saveDir, f"{variable}Map{month}.png")))
+    return figures
+
+
+def getAceFigure(diffHist, title, savePath, vmax=None):
+    """
+    Creates a figure for an ACE density anomaly map
+    :param diffHist: the ACE density anomaly map with shape (lon bin, lat bin)
+    :param title: the title of the map
+    :param savePath: the file path that the map is saved to
+    :param vmax: the magnitude of the ends of the color scale, defaults to the largest magnitude in the map
+    :return: the figure dictionary for renderFigure
+    """
+    if vmax is None:
+        vmax = np.max(np.abs(diffHist))
+    return dict(kind='ace', data=np.asarray(diffHist), title=title, savePath=savePath, vmax=vmax)
+
+
+def renderAll(figures, processes=None):
+    """
+    Renders every figure across a pool of processes, each of which builds its base maps once
+    :param figures: a list of figure dictionaries
+    :param processes: the number of processes, defaults to the number of CPUs
+    :return: the file paths that figures were saved to
+    """
+    if processes == 1 or len(figures) < 2:
+        return [renderFigure(figure) for figure in figures]
+
+    # group figures of the same kind so each process builds as few base maps as possible
+    figures = sorted(figures, key=lambda figure: figure['kind'])
+    processes = min(processes or os.cpu_count(), len(figures))
+    with mp.Pool(processes) as pool:
+        return pool.map(renderFigure, figures, chunksize=max(1, len(figures) // (processes * 4)))